@@ -0,0 +1,31 @@
+"""
+模板上下文处理器：所有页面的购物车角标(购物车中商品的条目数)
+"""
+from django.utils.functional import SimpleLazyObject
+from django_redis import get_redis_connection
+
+from apps.cart.operations import get_cart_key, get_cart_summary
+
+
+def _get_cart_count(request):
+    # 已登录为用户的购物车，未登录为游客购物车
+    cart_key, guest_id = get_cart_key(request, create=False)
+    if cart_key is None:
+        return 0
+    try:
+        # 'badge' 连接的超时时间很短，redis慢或不可用时直接显示0，不拖慢页面
+        conn = get_redis_connection('badge')
+        total_lines, total_units = get_cart_summary(conn, cart_key)
+    except Exception:
+        return 0
+    return total_lines
+
+
+def cart_count(request):
+    """
+    模板变量 cart_count
+    延迟获取：模板中用到时才访问redis，并且每个请求最多访问一次
+    """
+    if not hasattr(request, '_cart_count'):
+        request._cart_count = SimpleLazyObject(lambda: _get_cart_count(request))
+    return {'cart_count': request._cart_count}
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from apps.cart.operations import repair_cart_summaries
+
+
+class Command(BaseCommand):
+    help = '遍历redis中的全部购物车，重新统计购物车汇总(汇总与购物车不一致时使用)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='SCAN每次遍历的key数目')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        checked, fixed = repair_cart_summaries(conn, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('检查了 %d 个购物车，修正了 %d 个汇总' % (checked, fixed)))
@@ -0,0 +1,470 @@
+"""
+购物车记录的 redis 操作
+添加、更新、删除 都以服务器端 lua 脚本执行：读取-校验库存-写入-统计 在 redis 中一次完成，
+一次网络往返，并且是原子操作（两次并发的"加入购物车"不会丢失累加）
+库存读取redis中的库存镜像(apps.goods.stock)，镜像中没有的商品才从mysql加载
+
+每个购物车旁边维护一个汇总 summary_<购物车key>: {'lines': 条目数, 'units': 总件数}
+由上面的脚本增量更新，读取是 O(1) 的，不需要遍历购物车；汇总丢失时脚本会重新统计，
+汇总与购物车不一致时用 manage.py repair_cart_summary 重新统计
+
+未登录的用户使用游客购物车 cart_guest_<id>，id 保存在签名的cookie中，登录时合并到用户的购物车
+
+购物车和汇总设置了空闲过期时间 settings.CART_TTL，每次访问时刷新
+"""
+from django.conf import settings
+
+from apps.goods.models import GoodsSKU
+from apps.goods.stock import STOCK_KEY, load_stock
+from utils.redis_script import run_script
+
+import uuid
+
+# 游客购物车id的cookie(签名，防止伪造)
+GUEST_CART_COOKIE = 'cart_id'
+GUEST_CART_SALT = 'cart.guest'
+GUEST_CART_MAX_AGE = 30 * 24 * 3600
+
+# 汇总的读取 过期时间的刷新（脚本公共部分）
+# 汇总不存在时（第一次使用 或 被删除）遍历购物车重新统计
+# ARGV 的第一个参数是过期时间(由 _run_script 添加)，取出后各脚本其余参数的下标不变
+_CART_SUMMARY = """
+local ttl = tonumber(table.remove(ARGV, 1))
+
+local function touch(...)
+    if ttl > 0 then
+        for _, key in ipairs({...}) do
+            redis.call('expire', key, ttl)
+        end
+    end
+end
+
+local function load_summary(cart_key, summary_key)
+    -- 购物车不存在(空购物车)时不写入汇总，读取时按0处理
+    if redis.call('exists', summary_key) == 0 and redis.call('exists', cart_key) == 1 then
+        local total_units = 0
+        for _, val in ipairs(redis.call('hvals', cart_key)) do
+            total_units = total_units + tonumber(val)
+        end
+        redis.call('hmset', summary_key, 'lines', redis.call('hlen', cart_key), 'units', total_units)
+    end
+end
+
+local function get_summary(summary_key)
+    local summary = redis.call('hmget', summary_key, 'lines', 'units')
+    return tonumber(summary[1]) or 0, tonumber(summary[2]) or 0
+end
+"""
+
+# 添加：在购物车原有数目上累加，超过库存则不写入
+# KEYS[1] 购物车key  KEYS[2] 汇总key  KEYS[3] 库存镜像key  ARGV[1] sku_id  ARGV[2] 添加的数目
+# 镜像中没有该商品的库存时返回 {-1, 0, 0, 0}
+_CART_ADD = _CART_SUMMARY + """
+local stock = redis.call('hget', KEYS[3], ARGV[1])
+if not stock then
+    return {-1, 0, 0, 0}
+end
+load_summary(KEYS[1], KEYS[2])
+local old = redis.call('hget', KEYS[1], ARGV[1])
+local count = tonumber(old or 0) + tonumber(ARGV[2])
+local ok = 0
+if count <= tonumber(stock) then
+    redis.call('hset', KEYS[1], ARGV[1], count)
+    if not old then
+        redis.call('hincrby', KEYS[2], 'lines', 1)
+    end
+    redis.call('hincrby', KEYS[2], 'units', tonumber(ARGV[2]))
+    ok = 1
+end
+touch(KEYS[1], KEYS[2])
+local total_lines, total_units = get_summary(KEYS[2])
+return {ok, count, total_lines, total_units}
+"""
+
+# 更新：直接设置购物车中商品的数目，超过库存则不写入
+# KEYS[1] 购物车key  KEYS[2] 汇总key  KEYS[3] 库存镜像key  ARGV[1] sku_id  ARGV[2] 新的数目
+# 镜像中没有该商品的库存时返回 {-1, 0, 0, 0}
+_CART_UPDATE = _CART_SUMMARY + """
+local stock = redis.call('hget', KEYS[3], ARGV[1])
+if not stock then
+    return {-1, 0, 0, 0}
+end
+load_summary(KEYS[1], KEYS[2])
+local count = tonumber(ARGV[2])
+local ok = 0
+if count <= tonumber(stock) then
+    local old = redis.call('hget', KEYS[1], ARGV[1])
+    redis.call('hset', KEYS[1], ARGV[1], count)
+    if not old then
+        redis.call('hincrby', KEYS[2], 'lines', 1)
+    end
+    redis.call('hincrby', KEYS[2], 'units', count - tonumber(old or 0))
+    ok = 1
+end
+touch(KEYS[1], KEYS[2])
+local total_lines, total_units = get_summary(KEYS[2])
+return {ok, count, total_lines, total_units}
+"""
+
+# 删除：删除购物车中的商品记录（可以一次删除多条）
+# KEYS[1] 购物车key  KEYS[2] 汇总key  ARGV 要删除的sku_id
+_CART_DELETE = _CART_SUMMARY + """
+load_summary(KEYS[1], KEYS[2])
+for _, sku_id in ipairs(ARGV) do
+    local old = redis.call('hget', KEYS[1], sku_id)
+    if old then
+        redis.call('hdel', KEYS[1], sku_id)
+        redis.call('hincrby', KEYS[2], 'lines', -1)
+        redis.call('hincrby', KEYS[2], 'units', -tonumber(old))
+    end
+end
+touch(KEYS[1], KEYS[2])
+local total_lines, total_units = get_summary(KEYS[2])
+return {1, 0, total_lines, total_units}
+"""
+
+# 批量更新：先校验全部商品的库存，全部合格才写入（数目<=0 表示删除该商品）
+# KEYS[1] 购物车key  KEYS[2] 汇总key  KEYS[3] 库存镜像key  ARGV sku_id,数目,sku_id,数目...
+# 镜像中没有库存返回 {-1, {sku_id, ...}}，库存不足返回 {0, sku_id}，
+# 成功返回 {1, 条目数, 总件数, 购物车全部记录}
+_CART_BATCH = _CART_SUMMARY + """
+local missing = {}
+for i = 1, #ARGV, 2 do
+    if tonumber(ARGV[i + 1]) > 0 then
+        local stock = redis.call('hget', KEYS[3], ARGV[i])
+        if not stock then
+            table.insert(missing, ARGV[i])
+        elseif tonumber(ARGV[i + 1]) > tonumber(stock) then
+            return {0, ARGV[i]}
+        end
+    end
+end
+if #missing > 0 then
+    return {-1, missing}
+end
+load_summary(KEYS[1], KEYS[2])
+for i = 1, #ARGV, 2 do
+    local sku_id = ARGV[i]
+    local count = tonumber(ARGV[i + 1])
+    local old = redis.call('hget', KEYS[1], sku_id)
+    if count > 0 then
+        redis.call('hset', KEYS[1], sku_id, count)
+        if not old then
+            redis.call('hincrby', KEYS[2], 'lines', 1)
+        end
+        redis.call('hincrby', KEYS[2], 'units', count - tonumber(old or 0))
+    elseif old then
+        redis.call('hdel', KEYS[1], sku_id)
+        redis.call('hincrby', KEYS[2], 'lines', -1)
+        redis.call('hincrby', KEYS[2], 'units', -tonumber(old))
+    end
+end
+touch(KEYS[1], KEYS[2])
+local total_lines, total_units = get_summary(KEYS[2])
+return {1, total_lines, total_units, redis.call('hgetall', KEYS[1])}
+"""
+
+# 合并游客购物车到用户购物车：数目累加，不超过库存，合并后删除游客购物车
+# KEYS[1] 游客购物车key  KEYS[2] 游客汇总key  KEYS[3] 用户购物车key  KEYS[4] 用户汇总key  KEYS[5] 库存镜像key
+# 镜像中没有库存返回 {-1, {sku_id, ...}}(不做修改)，成功返回 {合并的条目数, 条目数, 总件数}
+_CART_MERGE = _CART_SUMMARY + """
+local guest = redis.call('hgetall', KEYS[1])
+local stocks = {}
+local missing = {}
+for i = 1, #guest, 2 do
+    local stock = redis.call('hget', KEYS[5], guest[i])
+    if stock then
+        stocks[guest[i]] = tonumber(stock)
+    else
+        table.insert(missing, guest[i])
+    end
+end
+if #missing > 0 then
+    return {-1, missing}
+end
+load_summary(KEYS[3], KEYS[4])
+local merged = 0
+for i = 1, #guest, 2 do
+    local sku_id = guest[i]
+    local old = redis.call('hget', KEYS[3], sku_id)
+    local count = math.min(tonumber(old or 0) + tonumber(guest[i + 1]), stocks[sku_id])
+    if count > 0 then
+        redis.call('hset', KEYS[3], sku_id, count)
+        if not old then
+            redis.call('hincrby', KEYS[4], 'lines', 1)
+        end
+        redis.call('hincrby', KEYS[4], 'units', count - tonumber(old or 0))
+        merged = merged + 1
+    end
+end
+redis.call('del', KEYS[1], KEYS[2])
+touch(KEYS[3], KEYS[4])
+local total_lines, total_units = get_summary(KEYS[4])
+return {merged, total_lines, total_units}
+"""
+
+# 读取汇总（不存在时重新统计）
+# KEYS[1] 购物车key  KEYS[2] 汇总key
+_CART_GET_SUMMARY = _CART_SUMMARY + """
+load_summary(KEYS[1], KEYS[2])
+touch(KEYS[1], KEYS[2])
+return {get_summary(KEYS[2])}
+"""
+
+# 修复汇总：丢弃现有的汇总，遍历购物车重新统计
+# 不刷新过期时间(修复不算用户访问)，新的汇总使用购物车剩余的过期时间
+# KEYS[1] 购物车key  KEYS[2] 汇总key
+# 返回 {是否修正, 条目数, 总件数}
+_CART_REPAIR_SUMMARY = _CART_SUMMARY + """
+local old = redis.call('hmget', KEYS[2], 'lines', 'units')
+redis.call('del', KEYS[2])
+load_summary(KEYS[1], KEYS[2])
+local pttl = redis.call('pttl', KEYS[1])
+if pttl > 0 then
+    redis.call('pexpire', KEYS[2], pttl)
+end
+local total_lines, total_units = get_summary(KEYS[2])
+local fixed = 0
+if (tonumber(old[1]) or 0) ~= total_lines or (tonumber(old[2]) or 0) ~= total_units then
+    fixed = 1
+end
+return {fixed, total_lines, total_units}
+"""
+
+def _run_script(conn, source, keys, args):
+    # 第一个参数为购物车的过期时间
+    return run_script(conn, source, keys, [settings.CART_TTL] + list(args))
+
+
+def cart_key_of(user):
+    # 用户购物车在redis中的key
+    return 'cart_%d' % user.id
+
+
+def guest_cart_key_of(guest_id):
+    # 游客购物车在redis中的key
+    return 'cart_guest_%s' % guest_id
+
+
+def get_cart_key(request, create=True):
+    """
+    获取当前请求的购物车key
+    已登录使用用户的购物车，未登录使用游客购物车
+    返回 (购物车key, 新建的游客购物车id)，新建的id需要用 set_guest_cart_cookie 写入cookie
+    没有游客购物车 并且 create=False 时返回 (None, None)
+    """
+    user = request.user
+    if user.is_authenticated:
+        return cart_key_of(user), None
+
+    guest_id = request.get_signed_cookie(GUEST_CART_COOKIE, default=None, salt=GUEST_CART_SALT)
+    if guest_id:
+        return guest_cart_key_of(guest_id), None
+    if not create:
+        return None, None
+
+    guest_id = uuid.uuid4().hex
+    return guest_cart_key_of(guest_id), guest_id
+
+
+def set_guest_cart_cookie(response, guest_id):
+    # 保存游客购物车id
+    if guest_id:
+        response.set_signed_cookie(GUEST_CART_COOKIE, guest_id, salt=GUEST_CART_SALT,
+                                   max_age=GUEST_CART_MAX_AGE, httponly=True)
+    return response
+
+
+def summary_key_of(cart_key):
+    # 购物车汇总在redis中的key
+    return 'summary_%s' % cart_key
+
+
+def _load_missing_stock(conn, sku_ids):
+    """
+    镜像中没有库存的商品，从mysql加载到镜像
+    返回mysql中也不存在的商品id
+    """
+    stocks = load_stock(conn, [int(sku_id) for sku_id in sku_ids])
+    return [int(sku_id) for sku_id in sku_ids if int(sku_id) not in stocks]
+
+
+def _cart_set(conn, source, cart_key, sku_id, count):
+    # 添加/更新，镜像中没有库存时从mysql加载后重试一次
+    keys = [cart_key, summary_key_of(cart_key), STOCK_KEY]
+    res = _run_script(conn, source, keys, [sku_id, count])
+    if res[0] == -1:
+        if _load_missing_stock(conn, [sku_id]):
+            raise GoodsSKU.DoesNotExist(sku_id)
+        res = _run_script(conn, source, keys, [sku_id, count])
+    ok, sku_count, total_lines, total_units = res
+    return ok == 1, sku_count, total_lines, total_units
+
+
+def cart_add(conn, cart_key, sku_id, count):
+    """
+    购物车记录添加（累加），库存从redis库存镜像读取
+    返回 (是否成功, 该商品在购物车中的数目, 购物车条目数, 购物车总件数)
+    库存不足时不写入，返回的数目为累加后的（超出库存的）数目
+    商品不存在时抛出 GoodsSKU.DoesNotExist
+    """
+    return _cart_set(conn, _CART_ADD, cart_key, sku_id, count)
+
+
+def cart_update(conn, cart_key, sku_id, count):
+    """
+    购物车记录更新（设置为count），库存从redis库存镜像读取
+    返回 (是否成功, 该商品在购物车中的数目, 购物车条目数, 购物车总件数)
+    商品不存在时抛出 GoodsSKU.DoesNotExist
+    """
+    return _cart_set(conn, _CART_UPDATE, cart_key, sku_id, count)
+
+
+def cart_delete(conn, cart_key, *sku_ids):
+    """
+    购物车记录删除（可以一次删除多条）
+    返回 (是否成功, 0, 购物车条目数, 购物车总件数)
+    """
+    keys = [cart_key, summary_key_of(cart_key)]
+    ok, sku_count, total_lines, total_units = _run_script(conn, _CART_DELETE, keys, list(sku_ids))
+    return bool(ok), sku_count, total_lines, total_units
+
+
+def cart_batch(conn, cart_key, items):
+    """
+    购物车记录批量更新（一次往返，全部成功或全部不修改），库存从redis库存镜像读取
+    items: [(sku_id, 数目), ...]，数目<=0 表示删除该商品
+    返回 (是否成功, 库存不足的sku_id, 购物车条目数, 购物车总件数, {sku_id: 数目})
+    有商品不存在时抛出 GoodsSKU.DoesNotExist(sku_id)
+    """
+    args = []
+    for sku_id, count in items:
+        args.extend([sku_id, count])
+    keys = [cart_key, summary_key_of(cart_key), STOCK_KEY]
+    res = _run_script(conn, _CART_BATCH, keys, args)
+    if res[0] == -1:
+        not_found = _load_missing_stock(conn, res[1])
+        if not_found:
+            raise GoodsSKU.DoesNotExist(not_found[0])
+        res = _run_script(conn, _CART_BATCH, keys, args)
+
+    if res[0] != 1:
+        return False, int(res[1]), None, None, None
+
+    ok, total_lines, total_units, flat = res
+    cart_dict = {int(flat[i]): int(flat[i + 1]) for i in range(0, len(flat), 2)}
+    return True, None, total_lines, total_units, cart_dict
+
+
+def merge_guest_cart(conn, request, user):
+    """
+    用户登录时，把游客购物车合并到用户的购物车（服务器端一次完成，数目不超过库存）
+    返回合并的条目数
+    """
+    guest_id = request.get_signed_cookie(GUEST_CART_COOKIE, default=None, salt=GUEST_CART_SALT)
+    if not guest_id:
+        return 0
+
+    guest_key = guest_cart_key_of(guest_id)
+    user_key = cart_key_of(user)
+    keys = [guest_key, summary_key_of(guest_key), user_key, summary_key_of(user_key), STOCK_KEY]
+    res = _run_script(conn, _CART_MERGE, keys, [])
+    if res[0] == -1:
+        # 镜像中没有库存：从mysql加载，已不存在的商品从游客购物车中删除，再合并一次
+        not_found = _load_missing_stock(conn, res[1])
+        if not_found:
+            cart_delete(conn, guest_key, *not_found)
+        res = _run_script(conn, _CART_MERGE, keys, [])
+        if res[0] == -1:
+            return 0
+
+    merged, total_lines, total_units = res
+    return merged
+
+
+def get_cart_summary(conn, cart_key):
+    """
+    获取购物车汇总 O(1)
+    返回 (购物车条目数, 购物车总件数)
+    """
+    total_lines, total_units = _run_script(conn, _CART_GET_SUMMARY, [cart_key, summary_key_of(cart_key)], [])
+    return total_lines, total_units
+
+
+def repair_cart_summary(conn, cart_key):
+    """
+    重新统计购物车汇总（汇总与购物车不一致时使用）
+    返回 (是否修正了汇总, 购物车条目数, 购物车总件数)
+    """
+    fixed, total_lines, total_units = _run_script(conn, _CART_REPAIR_SUMMARY,
+                                                  [cart_key, summary_key_of(cart_key)], [])
+    return fixed == 1, total_lines, total_units
+
+
+def repair_cart_summaries(conn, batch_size=500):
+    """
+    SCAN 遍历全部购物车，逐个重新统计汇总(manage.py repair_cart_summary)
+    返回 (检查的购物车数目, 修正的购物车数目)
+    """
+    checked = fixed = 0
+    for cart_key in conn.scan_iter(match='cart_*', count=batch_size):
+        if repair_cart_summary(conn, cart_key.decode())[0]:
+            fixed += 1
+        checked += 1
+    return checked, fixed
+
+
+def get_cart_skus(conn, cart_key, sku_ids=None):
+    """
+    获取购物车中商品的信息：一次 hgetall/hmget 获取数目，一次 in_bulk 查询获取商品
+    sku_ids 为 None 时获取购物车中的全部商品，否则按 sku_ids 的顺序获取指定商品
+    返回 (skus, total_count, total_price)，sku 动态增加了 count(数目) 和 amount(小计) 属性
+    购物车中没有记录 或 已不存在的商品会被跳过
+    """
+    if sku_ids is not None:
+        sku_ids = list(sku_ids)
+        if not sku_ids:
+            return [], 0, 0
+
+    # 读取的同时刷新过期时间(一次往返)
+    pipe = conn.pipeline(transaction=False)
+    if sku_ids is None:
+        pipe.hgetall(cart_key)
+    else:
+        pipe.hmget(cart_key, sku_ids)
+    if settings.CART_TTL:
+        pipe.expire(cart_key, settings.CART_TTL)
+        pipe.expire(summary_key_of(cart_key), settings.CART_TTL)
+    result = pipe.execute()[0]
+
+    if sku_ids is None:
+        # {b'商品id': b'商品数量', ...}
+        items = result.items()
+    else:
+        items = zip(sku_ids, result)
+
+    counts = []
+    for sku_id, count in items:
+        try:
+            counts.append((int(sku_id), int(count)))
+        except (TypeError, ValueError):
+            # 购物车中没有该商品的记录 或 id非法
+            continue
+
+    sku_dict = GoodsSKU.objects.in_bulk([sku_id for sku_id, count in counts])
+
+    skus = []
+    total_count = 0  # 商品的总件数
+    total_price = 0  # 商品的总价
+    for sku_id, count in counts:
+        sku = sku_dict.get(sku_id)
+        if sku is None:
+            continue
+        # 动态给sku增加属性 count(该商品数量) amount(小计)
+        sku.count = count
+        sku.amount = sku.price * count
+        skus.append(sku)
+        total_count += count
+        total_price += sku.amount
+
+    return skus, total_count, total_price
@@ -1,3 +1,67 @@
+import time
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django_redis import get_redis_connection
+
+from apps.cart.operations import cart_key_of, summary_key_of
+from apps.goods.factories import create_skus
+from apps.user.models import User
+from celery_tasks.tasks import _sweep_batch
 
 # Create your tests here.
+
+
+class CartInfoViewTest(TestCase):
+    """购物车页面的数据库查询次数与购物车中的商品条数无关"""
+
+    def setUp(self):
+        self.skus = create_skus(5)
+        self.user = User.objects.create_user('cart_test', 'cart_test@example.com', 'password')
+        self.client.force_login(self.user)
+
+        self.conn = get_redis_connection('default')
+        self.cart_key = cart_key_of(self.user)
+        self.conn.delete(self.cart_key, summary_key_of(self.cart_key))
+
+    def tearDown(self):
+        self.conn.delete(self.cart_key, summary_key_of(self.cart_key))
+
+    def test_queries_do_not_grow_with_cart_lines(self):
+        self.conn.hset(self.cart_key, self.skus[0].id, 1)
+        with CaptureQueriesContext(connection) as one_line:
+            response = self.client.get(reverse('cart:show'))
+        self.assertEqual(response.status_code, 200)
+
+        self.conn.hmset(self.cart_key, {sku.id: 2 for sku in self.skus})
+        with self.assertNumQueries(len(one_line.captured_queries)):
+            response = self.client.get(reverse('cart:show'))
+        self.assertEqual(len(response.context['skus']), len(self.skus))
+        self.assertEqual(response.context['total_count'], 2 * len(self.skus))
+
+
+class SweepIdleKeysTest(TestCase):
+    """清理长期不用的购物车：统计回收的内存包含购物车汇总占用的内存"""
+
+    def setUp(self):
+        self.conn = get_redis_connection('default')
+        self.cart_key = 'cart_sweep_test'
+        self.conn.hmset(self.cart_key, {sku_id: 1 for sku_id in range(1, 21)})
+        self.conn.hmset(summary_key_of(self.cart_key), {'lines': 20, 'units': 20})
+
+    def tearDown(self):
+        self.conn.delete(self.cart_key, summary_key_of(self.cart_key))
+
+    def test_reclaimed_bytes_include_summary(self):
+        expected = sum(self.conn.execute_command('MEMORY', 'USAGE', key)
+                       for key in (self.cart_key, summary_key_of(self.cart_key)))
+        # 空闲时间以秒计，等购物车空闲超过过期时间(1秒)
+        time.sleep(2.1)
+        stats = {'scanned': 0, 'deleted': 0, 'expire_set': 0, 'reclaimed_bytes': 0}
+        _sweep_batch(self.conn, [self.cart_key.encode()], 1, stats)
+
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(stats['reclaimed_bytes'], expected)
+        self.assertFalse(self.conn.exists(self.cart_key, summary_key_of(self.cart_key)))
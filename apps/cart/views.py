@@ -4,19 +4,19 @@ from django.urls import reverse
 from django.http import JsonResponse
 from django_redis import get_redis_connection
 
+import json
+
 from apps.goods.models import GoodsSKU
+from apps.cart.operations import get_cart_key, set_guest_cart_cookie, cart_add, cart_update, cart_delete, cart_batch, \
+    get_cart_skus
 
 
 # ajax 发起的请求都在后台，在浏览器中看不到效果，所以不能使用 mixin 判断登录状态
+# 未登录的用户使用游客购物车(id保存在签名cookie中，登录时合并到用户的购物车)
 # /cart/add （添加购物车记录）
 class CartAddView(View):
     # 购物车记录的添加
     def post(self, request):
-        # 用户的登陆状态（未登录退出，登录了则继续）
-        user = request.user
-        if not user.is_authenticated:
-            # 用户未登录
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
         # 接收数据
         sku_id = request.POST.get('sku_id')
         count = request.POST.get('count')
@@ -30,68 +30,38 @@ class CartAddView(View):
         except Exception as e:
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
+        # 业务处理（添加购物车记录）
+        # 累加购物车中的商品数目 校验商品的库存 并计算购物车中的条目数（lua脚本，一次往返完成）
+        # 库存读取redis中的库存镜像，不访问mysql
+        conn = get_redis_connection('default')
+        cart_key, guest_id = get_cart_key(request)
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
+            ok, sku_count, total_count, total_units = cart_add(conn, cart_key, sku_id, count)
         except GoodsSKU.DoesNotExist:
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
-        # 业务处理（添加购物车记录）
-        # 先尝试获取购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        # 先尝试获取sku_id --> hget cart_key 属性
-        cart_count = conn.hget(cart_key, sku_id)  # 如果拿不到，返回None
-        if cart_count:  # 累计购物车中的商品数目
-            count += int(cart_count)
-
         # 校验商品的库存
-        if count > sku.stock:
+        if not ok:
             return JsonResponse({'res': 4, 'errmsg': '库存不足'})
 
-        # 设置hash中cart_id对应的值（如果sku_id已经存在，更新数据;如果sku_id不存在，添加数据）
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车中商品的条目数量
-        total_count = conn.hlen(cart_key)
-
         # 返回应答
-        return JsonResponse({'res': 5, 'total_count': total_count, 'errmsg': '添加成功'})
+        response = JsonResponse({'res': 5, 'total_count': total_count, 'errmsg': '添加成功'})
+        # 未登录时保存游客购物车id
+        return set_guest_cart_cookie(response, guest_id)
 
 # 购物车页面
 class CartInfoView(View):
 
     def get(self, request):
-        # 获取登陆的用户
-        user = request.user
-        if not user.is_authenticated:
-            # 用户未登录
-            return redirect(reverse('user:login'))
-        # 获取用户购物车中的商品信息
-        conn = get_redis_connection('default')
-        # print(user.id)
-        cart_key = 'cart_%d' % user.id
-        # {'商品id': 商品数量，'商品id': 商品数量，。。。。。。}
-        cart_dict = conn.hgetall(cart_key)
-
-        skus = []
-        total_count = 0  # 保存购物车中的宗商品数量
-        total_price = 0  # 保存购物车中的商品总价
-        # 便利获取商品的信息
-        for sku_id, count in cart_dict.items():
-            # 根据商品的id过去商品的信息
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 计算商品的小计
-            amount = sku.price * int(count)
-
-            # 动态给sku对象增加一个属性amount，保存商品的小计
-            sku.amount = amount
-            # 动态给sku对象增加一个属性amount，保存商品的数量
-            sku.count = count.decode('utf8')
-            # 添加
-            skus.append(sku)
-            # 雷家计算总商品数量 和 总价格
-            total_count += int(count)
-            total_price += amount
+        # 获取购物车的key(已登录为用户的购物车，未登录为游客购物车)
+        cart_key, guest_id = get_cart_key(request, create=False)
+        if cart_key is None:
+            # 还没有游客购物车
+            skus, total_count, total_price = [], 0, 0
+        else:
+            # 获取购物车中的商品信息(一次 hgetall + 一次数据库查询)
+            conn = get_redis_connection('default')
+            skus, total_count, total_price = get_cart_skus(conn, cart_key)
 
         # 组织上下文
         context = {
@@ -107,11 +77,6 @@ class CartInfoView(View):
 class CarUpdateView(View):
 
     def post(self, request):
-        user = request.user
-        if not user.is_authenticated:
-            # 用户未登录
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
-
         # 接收数据
         sku_id = request.POST.get('sku_id')
         count = request.POST.get('count')
@@ -125,30 +90,24 @@ class CarUpdateView(View):
         except Exception as e:
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
+        # 处理业务(更新购物车记录)
+        # 校验商品的库存 更新 并计算购物车中商品的总件数（lua脚本，一次往返完成）
+        # 库存读取redis中的库存镜像，不访问mysql
+        conn = get_redis_connection('default')
+        cart_key, guest_id = get_cart_key(request)
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
+            ok, sku_count, total_lines, total_count = cart_update(conn, cart_key, sku_id, count)
         except GoodsSKU.DoesNotExist:
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
-        # 处理业务(更新购物车记录)
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
         # 校验商品的库存
-        if count > sku.stock:
+        if not ok:
             return JsonResponse({'res': 4, 'errmsg': '库存不足'})
-        # 设置hash中cart_id对应的值（如果sku_id已经存在，更新数据;如果sku_id不存在，添加数据）
-
-        # 更新
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车中商品的总件数
-        total_count = 0
-        for val in conn.hvals(cart_key):
-            total_count += int(val)
 
         # 返回应答
-        return JsonResponse({'res': 5, 'total_count': total_count, 'errmsg': '更新成功'})
+        response = JsonResponse({'res': 5, 'total_count': total_count, 'errmsg': '更新成功'})
+        # 未登录时保存游客购物车id
+        return set_guest_cart_cookie(response, guest_id)
 
 # 删除购物车记录
 # 采用ajax post请求
@@ -156,11 +115,6 @@ class CarUpdateView(View):
 class CartDeleteView(View):
 
     def post(self, request):
-        user = request.user
-        if not user.is_authenticated:
-            # 用户未登录
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
-
         # 接收数据
         sku_id = request.POST.get('sku_id')
 
@@ -168,24 +122,64 @@ class CartDeleteView(View):
         if not sku_id:
             return JsonResponse({'res': 1, 'errmsg': '无效的商品id'})
 
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
-
-        # 业务处理：删除购物车记录
+        # 业务处理：删除购物车记录(购物车中没有该商品时不做修改，不需要查询商品)
+        # 删除 并计算用户购物车中商品的总件数（lua脚本，一次往返完成）
         conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        # 删除
-        conn.hdel(cart_key, sku_id)
-        # 计算用户购物车中商品的总件数
-        total_count = 0
-        for val in conn.hvals(cart_key):
-            total_count += int(val)
+        cart_key, guest_id = get_cart_key(request)
+        ok, sku_count, total_lines, total_count = cart_delete(conn, cart_key, sku_id)
 
         # 返回应答
-        return JsonResponse({'res': 3, 'total_count': total_count, 'messmsg': '删除成功'})
+        response = JsonResponse({'res': 3, 'total_count': total_count, 'messmsg': '删除成功'})
+        # 未登录时保存游客购物车id
+        return set_guest_cart_cookie(response, guest_id)
+
+
+
+# 批量更新购物车记录(采用ajax post请求方式)
+# 参数 ops: json 列表 [{"sku_id": 商品id, "count": 商品数量}, ...]，数量为0表示删除该商品
+# 可以放在表单字段 ops 中，也可以直接以 application/json 作为请求体
+# /cart/batch
+class CartBatchView(View):
+
+    def post(self, request):
+        # 接收数据
+        try:
+            if request.content_type == 'application/json':
+                ops = json.loads(request.body.decode('utf8'))
+            else:
+                ops = json.loads(request.POST.get('ops', ''))
+        except ValueError:
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
 
+        # 校验数据(数据完整性 商品数量是否合格)
+        if not isinstance(ops, list) or not ops:
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
 
+        counts = []
+        try:
+            for op in ops:
+                counts.append((int(op['sku_id']), int(op['count'])))
+        except (TypeError, KeyError, ValueError):
+            return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
+        # 处理业务(批量更新购物车记录，lua脚本一次往返完成，库存不足时全部不修改)
+        # 库存读取redis中的库存镜像，不访问mysql
+        conn = get_redis_connection('default')
+        cart_key, guest_id = get_cart_key(request)
+        try:
+            ok, error_sku_id, total_lines, total_count, cart_dict = cart_batch(conn, cart_key, counts)
+        except GoodsSKU.DoesNotExist as e:
+            return JsonResponse({'res': 3, 'sku_id': e.args[0], 'errmsg': '商品不存在'})
+
+        # 校验商品的库存
+        if not ok:
+            return JsonResponse({'res': 4, 'sku_id': error_sku_id, 'errmsg': '库存不足'})
+
+        # 返回应答(购物车最终的记录)
+        response = JsonResponse({'res': 5,
+                                 'total_count': total_count,
+                                 'total_lines': total_lines,
+                                 'cart': cart_dict,
+                                 'errmsg': '更新成功'})
+        # 未登录时保存游客购物车id
+        return set_guest_cart_cookie(response, guest_id)
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.core.cache import cache
+from django_redis import get_redis_connection
 from apps.goods.models import GoodsType, GoodsSKU, Goods, GoodsImage, IndexGoodsBanner, IndexTypeBanner, IndexPromotionBanner
+from apps.goods.stock import set_stock, delete_stock
 # Register your models here.
 
 # 父模板，
@@ -32,7 +34,16 @@ class GoodsAdmin(BaseModeAdmin):
     pass
 
 class GoodsSKUAdmin(BaseModeAdmin):
-    pass
+    # 修改商品时同步redis中的库存镜像(减去秒杀进行中的预扣)
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        set_stock(get_redis_connection('default'), {obj.id: obj.stock})
+
+    # 删除商品时删除redis中的库存镜像
+    def delete_model(self, request, obj):
+        sku_id = obj.id
+        super().delete_model(request, obj)
+        delete_stock(get_redis_connection('default'), sku_id)
 
 class GoodsTypeAdmin(BaseModeAdmin):
     pass
@@ -0,0 +1,17 @@
+"""
+测试用的商品数据
+"""
+from apps.goods.models import GoodsType, Goods, GoodsSKU
+
+
+def create_skus(count, **fields):
+    """
+    创建同一种类、同一SPU下的count个商品sku(草莓0、草莓1...)，fields覆盖默认的字段值
+    返回商品sku列表(按id排序)
+    """
+    goods_type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+    goods = Goods.objects.create(name='草莓')
+    values = dict(desc='草莓', price=10, unite='盒', image='goods/strawberry.jpg', stock=100)
+    values.update(fields)
+    return [GoodsSKU.objects.create(type=goods_type, goods=goods, name='草莓%d' % i, **values)
+            for i in range(count)]
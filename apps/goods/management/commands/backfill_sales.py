@@ -0,0 +1,27 @@
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.goods.sales import backfill_sales
+
+
+class Command(BaseCommand):
+    help = '从订单表(含归档表)重新计算商品每日销量汇总'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='开始日期 YYYY-MM-DD(默认30天前)')
+        parser.add_argument('--end', help='结束日期 YYYY-MM-DD，包含这一天(默认今天)')
+
+    def parse_date(self, value, default):
+        if not value:
+            return default
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError('日期格式错误：%s' % value)
+
+    def handle(self, *args, **options):
+        start = self.parse_date(options['start'], date.today() - timedelta(days=30))
+        end = self.parse_date(options['end'], date.today())
+        total = backfill_sales(start, end + timedelta(days=1))
+        self.stdout.write(self.style.SUCCESS('销量汇总完成：%s ~ %s，共 %d 行' % (start, end, total)))
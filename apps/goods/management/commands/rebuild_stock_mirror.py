@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from apps.goods.stock import rebuild_stock
+
+
+class Command(BaseCommand):
+    help = '从mysql全量重建redis中的商品库存镜像'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批读取的商品数目')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        total = rebuild_stock(conn, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('重建库存镜像完成，共 %d 个商品' % total))
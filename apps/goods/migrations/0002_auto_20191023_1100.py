@@ -0,0 +1,35 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GoodsSKUDailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('count', models.IntegerField(default=0, verbose_name='销量')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='销售额')),
+                ('sku', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='goods.GoodsSKU', verbose_name='商品SKU')),
+            ],
+            options={
+                'verbose_name': '商品每日销量',
+                'verbose_name_plural': '商品每日销量',
+                'db_table': 'df_goods_sku_daily_sales',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='goodsskudailysales',
+            unique_together={('sku', 'date')},
+        ),
+        migrations.AddIndex(
+            model_name='goodsskudailysales',
+            index=models.Index(fields=['date'], name='df_sku_daily_sales_date_idx'),
+        ),
+    ]
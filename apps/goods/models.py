@@ -134,3 +134,21 @@ class IndexPromotionBanner(BaseModel):
 
 
 
+class GoodsSKUDailySales(models.Model):
+    '''商品每日销量汇总模型类(下单时增量累加，取消订单时减去)'''
+    sku = models.ForeignKey('GoodsSKU', verbose_name='商品SKU', on_delete=models.CASCADE)
+    date = models.DateField(verbose_name='日期')
+    count = models.IntegerField(default=0, verbose_name='销量')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='销售额')
+
+    class Meta:
+        db_table = 'df_goods_sku_daily_sales'
+        verbose_name = '商品每日销量'
+        verbose_name_plural = verbose_name
+        unique_together = ('sku', 'date')
+        indexes = [
+            models.Index(fields=['date'], name='df_sku_daily_sales_date_idx'),
+        ]
+
+    def __str__(self):
+        return '%s %s %s' % (self.sku_id, self.date, self.count)
@@ -0,0 +1,184 @@
+"""
+商品销量汇总 df_goods_sku_daily_sales: 每个商品每天一行 (销量, 销售额)
+
+下单成功(事务提交后)按下单日期累加，取消订单时减去，
+报表和热销排行(商品列表页的热销排行 hot_skus)只读汇总表(天数 x 商品数 行)，不再扫描 df_order_goods
+manage.py backfill_sales 从订单表(含归档表)重新计算历史数据
+
+GoodsSKU.sales 延迟写入：下单/取消订单时不在事务中修改商品行的sales(热门商品的行锁冲突)，
+事务提交后累加到redis goods_sales_delta: {sku_id: 增量}，定时任务 flush_sales 一次update写回mysql，
+需要实时销量时读 mysql的sales + redis中的增量(live_sales，商品详情页)
+"""
+import uuid
+from datetime import date, timedelta
+
+from django.db import connection, transaction
+from django.db.models import F, Sum, Case, When, IntegerField, DecimalField, ExpressionWrapper
+
+from apps.goods.models import GoodsSKU, GoodsSKUDailySales
+from apps.order.models import OrderGoods, OrderGoodsArchive
+from utils.redis_script import run_script
+from utils.transaction import safe_on_commit
+
+SALES_DELTA_KEY = 'goods_sales_delta'
+# 正在写回mysql的增量(写回过程中新的增量继续累加到 SALES_DELTA_KEY)
+SALES_FLUSHING_KEY = 'goods_sales_delta_flushing'
+# 写回锁，值为持有者的token
+SALES_FLUSH_LOCK_KEY = 'goods_sales_flush_lock'
+# 写回锁的过期时间(秒)，写回进程异常退出时锁自动释放
+SALES_FLUSH_LOCK_TTL = 300
+
+# 只释放自己持有的锁(锁过期后可能已被其他写回持有)
+_RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def buffer_sales(conn, deltas):
+    """
+    累加商品销量的增量 deltas: {sku_id: 增量}，增量可以为负数(取消订单)
+    """
+    if not deltas:
+        return
+    pipe = conn.pipeline(transaction=False)
+    for sku_id, delta in deltas.items():
+        pipe.hincrby(SALES_DELTA_KEY, sku_id, delta)
+    pipe.execute()
+
+
+def flush_sales(conn, batch_size=500):
+    """
+    把redis中的销量增量写回mysql，每批商品一条update语句
+    先把增量rename成写回中的key，每批update的事务提交后再从写回中的key删除这一批；
+    上次写回中途失败时先写回剩下的(事务回滚的批次留在写回中的key，不会丢失)
+    同一时间只有一个写回在运行(redis锁)，上一次写回还没结束时直接返回
+    返回写回的商品数目
+    """
+    token = uuid.uuid4().hex
+    if not conn.set(SALES_FLUSH_LOCK_KEY, token, nx=True, ex=SALES_FLUSH_LOCK_TTL):
+        # 其他写回正在运行(比定时任务的间隔慢，或者任务被重试)
+        return 0
+    try:
+        if not conn.exists(SALES_FLUSHING_KEY):
+            if not conn.exists(SALES_DELTA_KEY):
+                # 没有新的增量
+                return 0
+            conn.rename(SALES_DELTA_KEY, SALES_FLUSHING_KEY)
+
+        flushed = 0
+        sku_ids = conn.hkeys(SALES_FLUSHING_KEY)
+        for i in range(0, len(sku_ids), batch_size):
+            batch_ids = sku_ids[i:i + batch_size]
+            values = conn.hmget(SALES_FLUSHING_KEY, batch_ids)
+            batch = {int(sku_id): int(delta) for sku_id, delta in zip(batch_ids, values) if delta and int(delta)}
+            with transaction.atomic():
+                if batch:
+                    # update df_goods_sku set sales=sales+case id when ... end where id in (...)
+                    GoodsSKU.objects.filter(id__in=list(batch)).update(
+                        sales=Case(*[When(id=sku_id, then=F('sales') + delta) for sku_id, delta in batch.items()],
+                                   default=F('sales'), output_field=IntegerField()))
+                # 提交后才删除，写回的这一批全部删除后redis自动删除写回中的key
+                safe_on_commit(lambda batch_ids=batch_ids: conn.hdel(SALES_FLUSHING_KEY, *batch_ids))
+            flushed += len(batch)
+        return flushed
+    finally:
+        run_script(conn, _RELEASE_LOCK, keys=[SALES_FLUSH_LOCK_KEY], args=[token])
+
+
+def live_sales(conn, skus):
+    """
+    给商品加上还没写回mysql的销量增量(一次往返)，返回skus
+    """
+    if not skus:
+        return skus
+    pipe = conn.pipeline(transaction=False)
+    sku_ids = [sku.id for sku in skus]
+    pipe.hmget(SALES_DELTA_KEY, sku_ids)
+    pipe.hmget(SALES_FLUSHING_KEY, sku_ids)
+    pending, flushing = pipe.execute()
+    for sku, delta, flushing_delta in zip(skus, pending, flushing):
+        sku.sales += int(delta or 0) + int(flushing_delta or 0)
+    return skus
+
+
+def record_sales(day, lines):
+    """
+    累加某天的销量 lines: {sku_id: (数目, 金额)}，数目和金额可以为负数(取消订单)
+    一条 upsert 语句完成，不需要先查询：
+    mysql 用 insert ... on duplicate key update，sqlite/postgresql 用 insert ... on conflict do update
+    """
+    if not lines:
+        return
+    table = GoodsSKUDailySales._meta.db_table
+    if connection.vendor == 'mysql':
+        upsert = 'ON DUPLICATE KEY UPDATE count = count + VALUES(count), amount = amount + VALUES(amount)'
+    else:
+        upsert = ('ON CONFLICT (sku_id, date) DO UPDATE SET count = {0}.count + excluded.count, '
+                  'amount = {0}.amount + excluded.amount').format(table)
+    rows = [(sku_id, day, count, amount) for sku_id, (count, amount) in lines.items()]
+    with connection.cursor() as cursor:
+        cursor.executemany('INSERT INTO {} (sku_id, date, count, amount) VALUES (%s, %s, %s, %s) '.format(table) +
+                           upsert, rows)
+
+
+def sum_order_lines(lines):
+    """
+    按 (商品, 下单日期) 汇总订单商品 lines: OrderGoods/OrderGoodsArchive 的查询集
+    返回 [(sku_id, 下单日期, 数目, 金额)...]
+    """
+    amount = ExpressionWrapper(F('count') * F('price'), output_field=DecimalField(max_digits=12, decimal_places=2))
+    return list(lines.values_list('sku_id', 'order__create_time')
+                .annotate(total_count=Sum('count'), total_amount=Sum(amount)).order_by())
+
+
+def _order_lines_sales(model, start, end):
+    # 不含已取消的订单
+    return sum_order_lines(model.objects.filter(order__create_time__gte=start, order__create_time__lt=end)
+                           .exclude(order__order_status=6))
+
+
+def backfill_sales(start, end):
+    """
+    重新计算 [start, end) 这些天的销量汇总，每天一个事务
+    返回写入的汇总行数
+    """
+    total = 0
+    day = start
+    while day < end:
+        next_day = day + timedelta(days=1)
+        sales = {}
+        for model in (OrderGoods, OrderGoodsArchive):
+            for sku_id, create_time, count, amount in _order_lines_sales(model, day, next_day):
+                old_count, old_amount = sales.get(sku_id, (0, 0))
+                sales[sku_id] = (old_count + count, old_amount + amount)
+
+        with transaction.atomic():
+            GoodsSKUDailySales.objects.filter(date=day).delete()
+            GoodsSKUDailySales.objects.bulk_create([
+                GoodsSKUDailySales(sku_id=sku_id, date=day, count=count, amount=amount)
+                for sku_id, (count, amount) in sales.items()])
+        total += len(sales)
+        day = next_day
+    return total
+
+
+def hot_skus(days=7, limit=10, type=None):
+    """
+    最近days天销量最高的商品(按销量倒序)，可以限定商品种类
+    """
+    rows = GoodsSKUDailySales.objects.filter(date__gt=date.today() - timedelta(days=days))
+    if type is not None:
+        rows = rows.filter(sku__type=type)
+    rows = list(rows.values('sku_id').annotate(total=Sum('count')).order_by('-total')[:limit])
+
+    skus = GoodsSKU.objects.in_bulk([row['sku_id'] for row in rows])
+    result = []
+    for row in rows:
+        sku = skus.get(row['sku_id'])
+        if sku is not None:
+            sku.recent_sales = row['total']
+            result.append(sku)
+    return result
@@ -0,0 +1,258 @@
+"""
+商品库存在redis中的镜像 goods_stock: {sku_id: 库存}
+购物车校验库存时只读镜像，不访问mysql；下单时的库存校验仍以mysql为准(apps/order/service.py)
+
+镜像在以下时候更新：
+下单成功(事务提交后减去购买的数目)、后台修改/删除商品、取消订单归还库存、
+manage.py rebuild_stock_mirror 从mysql全量重建
+
+秒杀模式(settings.ORDER_COMMIT_STRATEGY = 'reservation')下单前先在镜像中预扣库存，抢到库存的请求才进入mysql事务：
+预扣的数目同时记在 goods_stock_reserved: {sku_id: 进行中的订单预扣的数目}，
+每次预扣记为一条预扣记录 goods_stock_reservation_items: {预扣id: 'sku_id:数目,...'}，
+goods_stock_reservations: zset {预扣id: 过期时间戳}，
+事务提交后确认(confirm_reservation)，失败或回滚时归还(release_reservation)，
+定时任务按 镜像 = mysql库存 - 进行中的预扣 对账(reconcile_stock)：
+先丢弃超过 settings.ORDER_RESERVATION_TTL 秒还没结束的预扣(进程在预扣后被杀掉)，再按mysql修正镜像
+
+从mysql加载、后台修改商品时镜像同样写入 mysql库存 - 进行中的预扣
+"""
+import time
+import uuid
+
+from django.conf import settings
+
+from apps.goods.models import GoodsSKU
+from utils.redis_script import run_script
+
+STOCK_KEY = 'goods_stock'
+RESERVED_KEY = 'goods_stock_reserved'
+RESERVATIONS_KEY = 'goods_stock_reservations'
+RESERVATION_ITEMS_KEY = 'goods_stock_reservation_items'
+
+# 增减镜像中的库存，镜像中没有的商品不处理(下次使用时从mysql加载)
+# KEYS[1] 镜像key  ARGV sku_id,增减数目,sku_id,增减数目...
+_STOCK_ADJUST = """
+for i = 1, #ARGV, 2 do
+    if redis.call('hexists', KEYS[1], ARGV[i]) == 1 then
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+return 1
+"""
+
+# 设置镜像中的库存为 mysql库存 - 进行中的预扣
+# KEYS[1] 镜像key  KEYS[2] 预扣key  ARGV[1] 为1时只写入镜像中没有的商品(从mysql加载)
+# ARGV sku_id,mysql库存,sku_id,mysql库存...
+_STOCK_SET = """
+local only_missing = ARGV[1] == '1'
+for i = 2, #ARGV, 2 do
+    if not only_missing or redis.call('hexists', KEYS[1], ARGV[i]) == 0 then
+        redis.call('hset', KEYS[1], ARGV[i], tonumber(ARGV[i + 1]) - tonumber(redis.call('hget', KEYS[2], ARGV[i]) or 0))
+    end
+end
+return 1
+"""
+
+# 预扣库存：全部商品的库存都足够才扣除，并记录预扣记录
+# KEYS[1] 镜像key  KEYS[2] 预扣key  KEYS[3] 预扣记录zset  KEYS[4] 预扣记录内容
+# ARGV[1] 预扣id  ARGV[2] 过期时间戳  ARGV[3] 'sku_id:数目,sku_id:数目...'
+# 镜像中没有库存返回 {-1, sku_id}，库存不足返回 {0, sku_id}，成功返回 {1, 0}
+_STOCK_RESERVE = """
+for sku_id, count in string.gmatch(ARGV[3], '(%d+):(%d+)') do
+    local stock = redis.call('hget', KEYS[1], sku_id)
+    if not stock then
+        return {-1, sku_id}
+    end
+    if tonumber(stock) < tonumber(count) then
+        return {0, sku_id}
+    end
+end
+for sku_id, count in string.gmatch(ARGV[3], '(%d+):(%d+)') do
+    redis.call('hincrby', KEYS[1], sku_id, -tonumber(count))
+    redis.call('hincrby', KEYS[2], sku_id, count)
+end
+redis.call('zadd', KEYS[3], ARGV[2], ARGV[1])
+redis.call('hset', KEYS[4], ARGV[1], ARGV[3])
+return {1, 0}
+"""
+
+# 结束预扣记录中的预扣：减少进行中的预扣数目，give_back 为真时同时把库存还给镜像(回滚)
+_FINISH_ITEMS = """
+local function finish(reservation_id, give_back)
+    local items = redis.call('hget', KEYS[4], reservation_id)
+    redis.call('zrem', KEYS[3], reservation_id)
+    redis.call('hdel', KEYS[4], reservation_id)
+    if not items then
+        return 0
+    end
+    for sku_id, count in string.gmatch(items, '(%d+):(%d+)') do
+        if give_back then
+            redis.call('hincrby', KEYS[1], sku_id, count)
+        end
+        if redis.call('hincrby', KEYS[2], sku_id, -tonumber(count)) <= 0 then
+            redis.call('hdel', KEYS[2], sku_id)
+        end
+    end
+    return 1
+end
+"""
+
+# 结束预扣(已经结束 或 已过期的预扣不再处理)
+# KEYS 同 _STOCK_RESERVE  ARGV[1] 预扣id  ARGV[2] 为1时把库存还给镜像
+_STOCK_FINISH_RESERVATION = _FINISH_ITEMS + """
+return finish(ARGV[1], ARGV[2] == '1')
+"""
+
+# 丢弃过期的预扣：只减少进行中的预扣数目，不归还镜像(订单可能已经提交)，由对账按mysql修正镜像
+# KEYS 同 _STOCK_RESERVE  ARGV[1] 当前时间戳  返回丢弃的预扣数目
+_STOCK_EXPIRE_RESERVATIONS = _FINISH_ITEMS + """
+local expired = redis.call('zrangebyscore', KEYS[3], '-inf', ARGV[1])
+for _, reservation_id in ipairs(expired) do
+    finish(reservation_id, false)
+end
+return #expired
+"""
+
+# 对账：镜像 = mysql库存 - 进行中的预扣，返回被修正的商品数目
+# KEYS[1] 镜像key  KEYS[2] 预扣key  ARGV sku_id,mysql库存,sku_id,mysql库存...
+_STOCK_RECONCILE = """
+local fixed = 0
+for i = 1, #ARGV, 2 do
+    local expected = tonumber(ARGV[i + 1]) - tonumber(redis.call('hget', KEYS[2], ARGV[i]) or 0)
+    if tonumber(redis.call('hget', KEYS[1], ARGV[i]) or -1) ~= expected then
+        redis.call('hset', KEYS[1], ARGV[i], expected)
+        fixed = fixed + 1
+    end
+end
+return fixed
+"""
+
+
+def _pairs(counts):
+    # {sku_id: 数目} ==> [sku_id, 数目, sku_id, 数目...]
+    args = []
+    for sku_id, count in counts.items():
+        args.extend([sku_id, count])
+    return args
+
+
+_RESERVATION_KEYS = [STOCK_KEY, RESERVED_KEY, RESERVATIONS_KEY, RESERVATION_ITEMS_KEY]
+
+
+def set_stock(conn, stocks, only_missing=False):
+    """
+    设置镜像中商品的库存 stocks: {sku_id: mysql库存}，镜像中为 mysql库存 - 进行中的预扣
+    only_missing为True时只写入镜像中还没有的商品(从mysql加载时不覆盖已有的镜像)
+    """
+    if stocks:
+        run_script(conn, _STOCK_SET, [STOCK_KEY, RESERVED_KEY], [int(only_missing)] + _pairs(stocks))
+
+
+def adjust_stock(conn, deltas):
+    """
+    增减镜像中商品的库存 deltas: {sku_id: 增减数目}
+    使用增量而不是设置绝对值，多个事务提交的先后顺序不影响结果
+    """
+    if deltas:
+        run_script(conn, _STOCK_ADJUST, [STOCK_KEY], _pairs(deltas))
+
+
+def delete_stock(conn, *sku_ids):
+    # 商品被删除
+    if sku_ids:
+        conn.hdel(STOCK_KEY, *sku_ids)
+
+
+def load_stock(conn, sku_ids):
+    """
+    从mysql加载商品的库存到镜像(一次查询)
+    返回 {sku_id: 库存}，不存在的商品不在其中
+    """
+    stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+    set_stock(conn, stocks, only_missing=True)
+    return stocks
+
+
+def reserve_stock(conn, counts):
+    """
+    秒杀模式下单前在镜像中预扣库存(一次往返，全部足够才扣除)
+    counts: {sku_id: 数目}
+    返回 (预扣id, 库存不足 或 不存在的sku_id)，预扣失败时预扣id为None
+    预扣超过 settings.ORDER_RESERVATION_TTL 秒还没有确认或归还，会被对账任务丢弃
+    """
+    reservation_id = uuid.uuid4().hex
+    items = ','.join('%d:%d' % (int(sku_id), count) for sku_id, count in counts.items())
+    args = [reservation_id, time.time() + settings.ORDER_RESERVATION_TTL, items]
+    res = run_script(conn, _STOCK_RESERVE, _RESERVATION_KEYS, args)
+    if res[0] == -1:
+        # 镜像中没有该商品的库存，从mysql加载后重试一次
+        load_stock(conn, list(counts.keys()))
+        res = run_script(conn, _STOCK_RESERVE, _RESERVATION_KEYS, args)
+    if res[0] != 1:
+        return None, int(res[1])
+    return reservation_id, None
+
+
+def confirm_reservation(conn, reservation_id):
+    # mysql事务已提交，预扣的库存正式扣除
+    run_script(conn, _STOCK_FINISH_RESERVATION, _RESERVATION_KEYS, [reservation_id, 0])
+
+
+def release_reservation(conn, reservation_id):
+    # 下单失败 或 事务回滚，归还预扣的库存
+    run_script(conn, _STOCK_FINISH_RESERVATION, _RESERVATION_KEYS, [reservation_id, 1])
+
+
+def expire_reservations(conn):
+    """
+    丢弃过期的预扣(预扣之后进程被杀掉，没有确认也没有归还)
+    返回丢弃的预扣数目
+    """
+    return run_script(conn, _STOCK_EXPIRE_RESERVATIONS, _RESERVATION_KEYS, [time.time()])
+
+
+def _iter_stock(batch_size):
+    # 按id分批读取mysql中商品的库存，避免一次加载全部商品
+    last_id = 0
+    while True:
+        rows = list(GoodsSKU.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'stock')[:batch_size])
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+
+def reconcile_stock(conn, batch_size=1000):
+    """
+    对账：镜像 = mysql库存 - 进行中的预扣(先丢弃过期的预扣)
+    返回 (检查的商品数目, 修正的商品数目)
+    """
+    expire_reservations(conn)
+    checked = fixed = 0
+    for rows in _iter_stock(batch_size):
+        fixed += run_script(conn, _STOCK_RECONCILE, [STOCK_KEY, RESERVED_KEY], _pairs(dict(rows)))
+        checked += len(rows)
+    return checked, fixed
+
+
+def rebuild_stock(conn, batch_size=1000):
+    """
+    从mysql全量重建镜像：先写入临时key，再 rename 原子替换(会去掉已删除的商品)
+    镜像中的库存为 mysql库存 - 进行中的预扣
+    返回重建的商品数目
+    """
+    tmp_key = STOCK_KEY + '_rebuild'
+    conn.delete(tmp_key)
+    expire_reservations(conn)
+
+    reserved = {int(sku_id): int(count) for sku_id, count in conn.hgetall(RESERVED_KEY).items()}
+    total = 0
+    for rows in _iter_stock(batch_size):
+        conn.hmset(tmp_key, {sku_id: stock - reserved.get(sku_id, 0) for sku_id, stock in rows})
+        total += len(rows)
+
+    if total:
+        conn.rename(tmp_key, STOCK_KEY)
+    else:
+        conn.delete(STOCK_KEY)
+    return total
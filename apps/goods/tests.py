@@ -1,3 +1,62 @@
-from django.test import TestCase
+from unittest import mock
+
+from django.db import DatabaseError
+from django.test import TransactionTestCase
+from django_redis import get_redis_connection
+
+from apps.goods.factories import create_skus
+from apps.goods.models import GoodsSKU
+from apps.goods.sales import (SALES_DELTA_KEY, SALES_FLUSHING_KEY, SALES_FLUSH_LOCK_KEY,
+                              buffer_sales, flush_sales, live_sales)
 
 # Create your tests here.
+
+
+class FlushSalesTest(TransactionTestCase):
+    """redis中的销量增量写回mysql：只写回一次，写回失败不丢失，写回之前读到的实时销量包含增量"""
+
+    def setUp(self):
+        self.skus = create_skus(3, sales=10)
+        self.conn = get_redis_connection('default')
+        self.conn.delete(SALES_DELTA_KEY, SALES_FLUSHING_KEY, SALES_FLUSH_LOCK_KEY)
+
+    def tearDown(self):
+        self.conn.delete(SALES_DELTA_KEY, SALES_FLUSHING_KEY, SALES_FLUSH_LOCK_KEY)
+
+    def sales(self):
+        return [GoodsSKU.objects.get(id=sku.id).sales for sku in self.skus]
+
+    def sales_skus(self):
+        return list(GoodsSKU.objects.filter(id__in=[sku.id for sku in self.skus]).order_by('id'))
+
+    def test_flush_applies_deltas_once(self):
+        buffer_sales(self.conn, {self.skus[0].id: 3, self.skus[1].id: -2, self.skus[2].id: 0})
+        self.assertEqual([sku.sales for sku in live_sales(self.conn, self.sales_skus())], [13, 8, 10])
+
+        self.assertEqual(flush_sales(self.conn, batch_size=1), 2)
+        self.assertEqual(self.sales(), [13, 8, 10])
+        # 再次写回没有增量
+        self.assertEqual(flush_sales(self.conn), 0)
+        self.assertEqual(self.sales(), [13, 8, 10])
+        self.assertEqual([sku.sales for sku in live_sales(self.conn, self.sales_skus())], [13, 8, 10])
+
+    def test_flush_skipped_while_locked(self):
+        buffer_sales(self.conn, {self.skus[0].id: 3})
+        self.conn.set(SALES_FLUSH_LOCK_KEY, 'other')
+        self.assertEqual(flush_sales(self.conn), 0)
+        self.assertEqual(self.sales(), [10, 10, 10])
+        # 不释放其他写回持有的锁
+        self.assertEqual(self.conn.get(SALES_FLUSH_LOCK_KEY), b'other')
+
+    def test_failed_flush_keeps_deltas(self):
+        buffer_sales(self.conn, {self.skus[0].id: 3, self.skus[1].id: 1})
+        with mock.patch.object(GoodsSKU.objects, 'filter', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                flush_sales(self.conn)
+        self.assertEqual(self.sales(), [10, 10, 10])
+        # 没有写回的增量留在redis中，实时销量不变，下次写回
+        self.assertEqual([sku.sales for sku in live_sales(self.conn, self.sales_skus())], [13, 11, 10])
+
+        self.assertEqual(flush_sales(self.conn), 2)
+        self.assertEqual(self.sales(), [13, 11, 10])
+        self.assertEqual(flush_sales(self.conn), 0)
@@ -2,9 +2,11 @@ from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views.generic import View
 from django.core.cache import cache
+from django.conf import settings
 from django.core.paginator import Paginator  # 进行分页操作
 from apps.goods.models import *
-from apps.order.models import OrderGoods
+from apps.order.archive import get_sku_comments
+from apps.goods.sales import hot_skus as get_hot_skus, live_sales
 from django_redis import get_redis_connection
 
 
@@ -41,22 +43,12 @@ class IndexView(View):
                 'types': types,
                 'goods_banners': goods_banners,
                 'promotion_banners': promotion_bannsers,
-                'cart_count': 0,
             }
 
             # 设置缓存(key  value timeout)
             cache.set('index_page_data', context, 3600)
 
-        # 获取用户购物车记录(不能设置在缓存中，应该每次加载都获取用户的购物车信息)
-        user = request.user
-        cart_count = 0
-        if user.is_authenticated:
-            # 用户已登录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = conn.hlen(cart_key)  # 获取商品种类数目
-
-        context['cart_count'] = cart_count
+        # 用户购物车记录(不能设置在缓存中)由上下文处理器 apps.cart.context_processors.cart_count 提供
 
         # 使用模板
         return render(request, 'index.html', context)
@@ -77,7 +69,8 @@ class DetailView(View):
         types = GoodsType.objects.all()
 
         # 获取商品的评论信息
-        sku_orders = OrderGoods.objects.filter(sku=sku).exclude(comment='')  # 排除(exclude)为空的数据
+        # 排除(exclude)为空的数据，已归档订单的评论也要显示
+        sku_orders = get_sku_comments(sku)
 
         # 获取新品信息
         new_skus = GoodsSKU.objects.filter(type=sku.type).order_by('-create_time')[:2]
@@ -85,24 +78,27 @@ class DetailView(View):
         # 获取同一个SPU的其他规格商品
         same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(id=goods_id)
 
-        # 获取用户购物车中商品的数目
+        # 商品销量：mysql中的sales + redis中还没写回的增量
+        conn = get_redis_connection('default')
+        live_sales(conn, [sku])
+
+        # 用户购物车中商品的数目由上下文处理器 apps.cart.context_processors.cart_count 提供
         user = request.user
-        cart_count = 0
         if user.is_authenticated:
             # 用户已登录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = conn.hlen(cart_key)
-
             # 添加用户的历史浏览记录（用户最新浏览的商品id从列表左侧插入，在redis中用列表格式存储）
             # 去重
-            conn = get_redis_connection('default')
+            # (使用管道，一次往返完成，并刷新浏览记录的过期时间)
             history_key = 'history_%d' % user.id
-            conn.lrem(history_key, 0, goods_id)  # 移除列表中的goods_id
+            pipe = conn.pipeline()
+            pipe.lrem(history_key, 0, goods_id)  # 移除列表中的goods_id
             # 2 将 goods_id 从列表的左侧插入
-            conn.lpush(history_key, goods_id)
+            pipe.lpush(history_key, goods_id)
             # 只用保存用户最新浏览的5条信息
-            conn.ltrim(history_key, 0, 4)
+            pipe.ltrim(history_key, 0, 4)
+            if settings.HISTORY_TTL:
+                pipe.expire(history_key, settings.HISTORY_TTL)
+            pipe.execute()
 
 
         # 组织上下文
@@ -112,7 +108,6 @@ class DetailView(View):
             'sku_orders': sku_orders,
             'new_skus': new_skus,
             'same_spu_skus': same_spu_skus,
-            'cart_count': cart_count,
         }
 
         # 使用模板
@@ -140,6 +135,9 @@ class ListView(View):
         # 获取新品信息
         new_skus = GoodsSKU.objects.filter(id=goods_type_id).order_by('-create_time')[:2]
 
+        # 获取最近7天的热销排行(读每日销量汇总表)
+        hot_skus = get_hot_skus(days=7, limit=3, type=type)
+
         # 获取排序方式
         # sort=default 按照默认id排序
         # sort=price 价格排序
@@ -182,23 +180,16 @@ class ListView(View):
         else:
             pages = range(page-2, page+3)
 
-        # 获取用户购物车中商品的数目
-        user = request.user
-        cart_count = 0
-        if user.is_authenticated:
-            # 用户已登录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = conn.hlen(cart_key)
+        # 用户购物车中商品的数目由上下文处理器 apps.cart.context_processors.cart_count 提供
 
         # 组织上下文
         context = {
             'type': type,  # 该分页商品类型
             'types': types,  # 所有商品类型
             'new_skus': new_skus,  # 新品推荐
+            'hot_skus': hot_skus,  # 热销排行
             'skus_page': skus_page,  # 该分页商品
             'pages': pages,  # 分页格式
-            'cart_count': cart_count,  # 购物车信息
             'sort': sort
         }
 
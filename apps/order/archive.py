@@ -0,0 +1,150 @@
+"""
+订单归档(冷热分离)
+
+已完成、已取消且创建超过 settings.ORDER_ARCHIVE_DAYS 天的订单，分批移到归档表
+df_order_info_archive / df_order_goods_archive，热表只保留最近的订单，索引能常驻内存
+
+读订单时先查热表，热表中没有(或分页时热表的数据不够)再查归档表：
+归档的订单都早于归档时的截止日期，热表中截止日期之后的订单一定排在所有归档订单前面
+"""
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Prefetch, prefetch_related_objects
+
+from apps.order.models import OrderInfo, OrderGoods, OrderInfoArchive, OrderGoodsArchive
+
+# 可以归档的订单状态：已完成、已取消
+ARCHIVE_STATUS = (5, 6)
+
+_INFO_FIELDS = ('order_id', 'user_id', 'addr_id', 'pay_method', 'total_count', 'total_price', 'transit_price',
+                'order_status', 'trade_no', 'create_time', 'update_time', 'is_delete')
+_GOODS_FIELDS = ('order_id', 'sku_id', 'count', 'price', 'comment', 'create_time', 'update_time', 'is_delete')
+
+
+def archive_cutoff():
+    # 早于这一天创建的订单可以归档
+    return date.today() - timedelta(days=settings.ORDER_ARCHIVE_DAYS)
+
+
+@transaction.atomic
+def _archive_batch(order_ids):
+    # 复制到归档表，再从热表删除(同一个事务)
+    infos = OrderInfo.objects.select_for_update().filter(order_id__in=order_ids, order_status__in=ARCHIVE_STATUS)
+    infos = list(infos.values(*_INFO_FIELDS))
+    if not infos:
+        return 0
+    order_ids = [info['order_id'] for info in infos]
+    goods = list(OrderGoods.objects.filter(order_id__in=order_ids).values(*_GOODS_FIELDS))
+
+    OrderInfoArchive.objects.bulk_create([OrderInfoArchive(**info) for info in infos])
+    OrderGoodsArchive.objects.bulk_create([OrderGoodsArchive(**line) for line in goods])
+
+    OrderGoods.objects.filter(order_id__in=order_ids).delete()
+    OrderInfo.objects.filter(order_id__in=order_ids).delete()
+    return len(order_ids)
+
+
+def archive_orders(batch_size=500, limit=None):
+    """
+    分批归档订单，每批一个事务，返回归档的订单数目
+    limit: 本次最多归档的订单数目(None 不限)
+    """
+    cutoff = archive_cutoff()
+    total = 0
+    last_id = ''
+    while limit is None or total < limit:
+        size = batch_size if limit is None else min(batch_size, limit - total)
+        order_ids = list(OrderInfo.objects.filter(order_status__in=ARCHIVE_STATUS, create_time__lt=cutoff,
+                                                  order_id__gt=last_id)
+                         .order_by('order_id').values_list('order_id', flat=True)[:size])
+        if not order_ids:
+            break
+        last_id = order_ids[-1]
+        total += _archive_batch(order_ids)
+    return total
+
+
+def get_order(**kwargs):
+    """
+    按条件获取一个订单，先查热表，再查归档表
+    归档的订单 archived 属性为True
+    """
+    try:
+        order = OrderInfo.objects.get(**kwargs)
+        order.archived = False
+    except OrderInfo.DoesNotExist:
+        try:
+            order = OrderInfoArchive.objects.get(**kwargs)
+        except OrderInfoArchive.DoesNotExist:
+            raise OrderInfo.DoesNotExist
+        order.archived = True
+    return order
+
+
+def get_order_skus(order):
+    """获取订单的商品信息(同时取出商品sku)"""
+    if order.archived:
+        return OrderGoodsArchive.objects.filter(order=order.order_id).select_related('sku')
+    return OrderGoods.objects.filter(order=order.order_id).select_related('sku')
+
+
+def get_sku_comments(sku):
+    """
+    获取商品的评论(热表和归档表合在一起，按创建时间排序)
+    同时取出下单的用户
+    """
+    comments = []
+    for model in (OrderGoods, OrderGoodsArchive):
+        comments += model.objects.filter(sku=sku).exclude(comment='').select_related('order__user')
+    comments.sort(key=lambda line: line.create_time)
+    return comments
+
+
+def _order_page(model, user, cursor, descending, size):
+    orders = model.objects.filter(user=user)
+    if cursor:
+        create_time, order_id = cursor
+        if descending:
+            orders = orders.filter(Q(create_time__lt=create_time) |
+                                   Q(create_time=create_time, order_id__lt=order_id))
+        else:
+            orders = orders.filter(Q(create_time__gt=create_time) |
+                                   Q(create_time=create_time, order_id__gt=order_id))
+    if descending:
+        orders = orders.order_by('-create_time', '-order_id')
+    else:
+        orders = orders.order_by('create_time', 'order_id')
+    orders = list(orders[:size])
+    for order in orders:
+        order.archived = model is OrderInfoArchive
+    return orders
+
+
+def get_order_page(user, cursor, descending, size):
+    """
+    按 (创建时间, 订单id) 游标分页获取用户的订单，热表和归档表合在一起
+    descending为True时取游标之后(更早)的size个订单，否则取游标之前(更新)的size个订单(正序)
+    订单的商品信息保存在 order_skus 属性中
+    """
+    orders = _order_page(OrderInfo, user, cursor, descending, size)
+
+    # 只有可能排到归档订单之后时才查询归档表
+    cutoff = archive_cutoff()
+    if descending:
+        need_archive = len(orders) < size or orders[-1].create_time < cutoff
+    else:
+        need_archive = cursor is not None and cursor[0] < cutoff
+    if need_archive:
+        orders += _order_page(OrderInfoArchive, user, cursor, descending, size)
+        orders.sort(key=lambda order: (order.create_time, order.order_id), reverse=descending)
+        orders = orders[:size]
+
+    # 热表和归档表的订单各用一次查询取出商品信息
+    for model, lines in ((OrderInfo, OrderGoods), (OrderInfoArchive, OrderGoodsArchive)):
+        prefetch_related_objects([order for order in orders if isinstance(order, model)],
+                                 Prefetch(lines.__name__.lower() + '_set',
+                                          queryset=lines.objects.select_related('sku'),
+                                          to_attr='order_skus'))
+    return orders
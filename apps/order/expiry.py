@@ -0,0 +1,129 @@
+"""
+未支付订单超时取消
+
+延时队列 order_expire: zset {订单id: 超时时间戳}，下单成功后加入，
+支付时把超时时间作为支付宝交易的绝对超时时间(time_expire)，超时后不能再支付
+定时任务 expire_unpaid_orders 取出到期的订单，先关闭支付平台上的交易(已经支付的改为已支付，关闭失败的稍后重试)，
+再取消仍未支付的订单并归还库存：
+一次update修改订单状态，一次update归还全部商品的库存(与订单数目无关)，销量通过redis延迟写回
+
+与支付通知并发时以先修改订单状态的一方为准：
+取消时锁住待支付的订单行，支付通知的 update ... where order_status=1 会等待锁，
+取消提交后该条件不再成立，支付不会被记到已取消的订单上(反之亦然)
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Case, When, IntegerField
+from django_redis import get_redis_connection
+
+from apps.goods.models import GoodsSKU
+from apps.goods.stock import adjust_stock
+from apps.goods.sales import record_sales, sum_order_lines, buffer_sales
+from apps.order.models import OrderInfo, OrderGoods
+from utils.transaction import safe_on_commit
+
+EXPIRE_KEY = 'order_expire'
+# 关闭交易失败的订单过多少秒再处理
+CLOSE_RETRY_DELAY = 60
+
+
+def schedule_expiry(conn, order_id, timeout=None):
+    """订单在timeout秒后未支付则取消"""
+    if timeout is None:
+        timeout = settings.ORDER_PAY_TIMEOUT
+    conn.zadd(EXPIRE_KEY, {order_id: time.time() + timeout})
+
+
+def get_expiry(conn, order_id):
+    """订单超时取消的时间戳，不在延时队列中(已支付、已取消)返回None"""
+    return conn.zscore(EXPIRE_KEY, order_id)
+
+
+def cancel_expiry(conn, *order_ids):
+    # 订单已支付，不需要再取消
+    if order_ids:
+        conn.zrem(EXPIRE_KEY, *order_ids)
+
+
+@transaction.atomic
+def cancel_orders(order_ids):
+    """
+    取消仍未支付的订单并归还库存，返回 (取消的订单id列表, 归还的库存 {sku_id: 数目})
+    """
+    # 锁住待支付的订单行，期间支付通知无法修改这些订单
+    cancelled = list(OrderInfo.objects.select_for_update()
+                     .filter(order_id__in=order_ids, order_status=1)
+                     .values_list('order_id', flat=True))
+    if not cancelled:
+        return [], {}
+
+    OrderInfo.objects.filter(order_id__in=cancelled).update(order_status=6)
+
+    # 各商品要归还的数目(一次查询，按下单日期分开，同时用于减去销量汇总)
+    lines = sum_order_lines(OrderGoods.objects.filter(order_id__in=cancelled))
+    counts = {}
+    sales = {}
+    for sku_id, day, count, amount in lines:
+        counts[sku_id] = counts.get(sku_id, 0) + count
+        sales.setdefault(day, {})[sku_id] = (-count, -amount)
+
+    if counts:
+        # update df_goods_sku set stock=stock+case ... end where id in (...)
+        GoodsSKU.objects.filter(id__in=list(counts.keys())).update(
+            stock=Case(*[When(id=sku_id, then=F('stock') + count) for sku_id, count in counts.items()],
+                       default=F('stock'), output_field=IntegerField()))
+
+    # 事务提交后减去销量(延迟写回mysql) 和 销量汇总
+    negative = {sku_id: -count for sku_id, count in counts.items()}
+    safe_on_commit(lambda: buffer_sales(get_redis_connection('default'), negative))
+    for day, day_sales in sales.items():
+        safe_on_commit(lambda day=day, day_sales=day_sales: record_sales(day, day_sales))
+
+    return cancelled, counts
+
+
+def expire_orders(conn, batch_size=200, client=None):
+    """
+    处理延时队列中到期的订单：先关闭支付平台上的交易，确认没有支付再取消
+    返回 (到期的订单数目, 取消的订单数目, 到期时已经支付的订单数目)
+    """
+    # payment 引用了本模块
+    from apps.order.payment import get_payment_client, close_trades, mark_orders_paid
+    if client is None:
+        client = get_payment_client()
+
+    due = cancelled_total = paid_total = 0
+    while True:
+        order_ids = [order_id.decode() for order_id in
+                     conn.zrangebyscore(EXPIRE_KEY, '-inf', time.time(), start=0, num=batch_size)]
+        if not order_ids:
+            break
+
+        pending = list(OrderInfo.objects.filter(order_id__in=order_ids, order_status=1)
+                       .values_list('order_id', flat=True))
+        closed, paid, failed = close_trades(client, pending)
+        if paid:
+            # 超时前已经支付(通知还没到)
+            mark_orders_paid(paid)
+
+        cancelled, counts = cancel_orders(closed)
+        # 事务已提交，把归还的库存同步到redis库存镜像
+        adjust_stock(conn, counts)
+
+        # 处理完再移出队列，中途失败的订单下次还会被处理(重复处理时订单已不是待支付，不会重复归还)
+        # 关闭交易失败的订单推迟一段时间再处理
+        failed_ids = set(failed)
+        done = [order_id for order_id in order_ids if order_id not in failed_ids]
+        if done:
+            conn.zrem(EXPIRE_KEY, *done)
+        if failed:
+            conn.zadd(EXPIRE_KEY, {order_id: time.time() + CLOSE_RETRY_DELAY for order_id in failed})
+
+        due += len(order_ids)
+        cancelled_total += len(cancelled)
+        paid_total += len(paid)
+        if len(order_ids) < batch_size:
+            break
+    return due, cancelled_total, paid_total
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.order.archive import archive_orders
+
+
+class Command(BaseCommand):
+    help = '把已完成、已取消的历史订单分批移到归档表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每批(每个事务)归档的订单数目')
+        parser.add_argument('--limit', type=int, default=None, help='本次最多归档的订单数目')
+
+    def handle(self, *args, **options):
+        total = archive_orders(options['batch_size'], options['limit'])
+        self.stdout.write(self.style.SUCCESS('归档完成，共 %d 个订单' % total))
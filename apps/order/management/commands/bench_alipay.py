@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.order.payment import create_alipay, get_alipay, verify_notify
+
+
+class Command(BaseCommand):
+    help = '测量支付宝客户端的创建、签名、验签耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=200, help='每项重复的次数')
+
+    def timeit(self, name, func, number):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        cost = (time.perf_counter() - start) / number * 1000
+        self.stdout.write('%-32s %10.3f ms' % (name, cost))
+
+    def handle(self, *args, **options):
+        number = options['number']
+        alipay = get_alipay()
+
+        def page_pay():
+            alipay.api_alipay_trade_page_pay(out_trade_no='0123456789012345678',
+                                             total_amount='0.01',
+                                             subject='天天生鲜 0123456789012345678',
+                                             return_url=None,
+                                             notify_url='http://127.0.0.1/order/notify')
+
+        # 用应用的私钥造一条已签名的通知，走webhook实际使用的验签路径 verify_notify(get_alipay(), ...)
+        # (没有支付宝的私钥，验签结果为失败，但计算量与验证真实通知相同)
+        data = {'out_trade_no': '0123456789012345678', 'trade_no': '2019030722001497820200941406',
+                'trade_status': 'TRADE_SUCCESS', 'total_amount': '0.01', 'app_id': alipay.appid}
+        message = '&'.join('{}={}'.format(k, v) for k, v in alipay._ordered_data(data))
+        signed_data = dict(data, sign=alipay._sign(message), sign_type=alipay._sign_type)
+
+        def verify():
+            verify_notify(get_alipay(), signed_data)
+
+        self.timeit('create client (per request)', create_alipay, number)
+        self.timeit('get_alipay (shared)', get_alipay, number)
+        self.timeit('sign page pay', page_pay, number)
+        self.timeit('verify notify', verify, number)
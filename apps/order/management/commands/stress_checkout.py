@@ -0,0 +1,148 @@
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.test import Client, override_settings
+from django.urls import reverse
+from django_redis import get_redis_connection
+
+from apps.cart.operations import cart_key_of, summary_key_of
+from apps.goods.models import GoodsType, Goods, GoodsSKU
+from apps.goods.stock import delete_stock
+from apps.order.expiry import cancel_expiry
+from apps.order.models import OrderInfo, OrderGoods
+from apps.order.service import STRATEGIES, CONTENTION_KEY
+from apps.user.models import User, Address
+
+
+class Command(BaseCommand):
+    help = '下单压力测试：少量库存的商品被大量用户通过 /order/commit 并发下单，检查是否超卖，统计吞吐量和延迟'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skus', type=int, default=3, help='商品数目')
+        parser.add_argument('--stock', type=int, default=50, help='每个商品的初始库存')
+        parser.add_argument('--users', type=int, default=200, help='下单的用户数目(每个用户下一单)')
+        parser.add_argument('--concurrency', type=int, default=16, help='并发下单的线程数')
+        parser.add_argument('--max-count', type=int, default=3, help='每个商品最多购买的数目')
+        parser.add_argument('--strategy', choices=STRATEGIES, default=None, help='下单策略(默认使用settings)')
+        parser.add_argument('--keep', action='store_true', help='保留测试数据')
+        parser.add_argument('--queue-timeout', type=float, default=30, help='排队下单时最多等待结果的秒数')
+
+    def handle(self, *args, **options):
+        strategy = options['strategy'] or settings.ORDER_COMMIT_STRATEGY
+        # Django测试客户端的请求使用 testserver 作为域名
+        with override_settings(ORDER_COMMIT_STRATEGY=strategy,
+                               ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+            self.run_stress(options)
+
+    def post_commit(self, client, addr, sku_ids, queue_timeout):
+        # 与浏览器一样提交订单(带幂等键)，排队下单时轮询排队号直到有结果
+        result = client.post(reverse('order:commit'), {'addr_id': addr.id, 'pay_method': 3,
+                                                       'sku_ids': ','.join(sku_ids),
+                                                       'idempotency_key': uuid.uuid4().hex}).json()
+        deadline = time.time() + queue_timeout
+        while result['res'] == 8 and time.time() < deadline:
+            time.sleep(0.05)
+            result = client.get(reverse('order:status', kwargs={'ticket': result['ticket']})).json()
+        return result
+
+    def run_stress(self, options):
+        conn = get_redis_connection('default')
+        tag = 'stress-%s' % uuid.uuid4().hex[:8]
+
+        # 准备商品和用户
+        goods_type = GoodsType.objects.create(name=tag, logo=tag[:20], image='type/stress.jpg')
+        goods = Goods.objects.create(name=tag)
+        GoodsSKU.objects.bulk_create([GoodsSKU(type=goods_type, goods=goods, name='%s-%d' % (tag, i), desc=tag,
+                                               price=1, unite='个', image='goods/stress.jpg', stock=options['stock'])
+                                      for i in range(options['skus'])])
+        sku_ids = list(GoodsSKU.objects.filter(goods=goods).values_list('id', flat=True))
+        initial = {sku_id: options['stock'] for sku_id in sku_ids}
+
+        User.objects.bulk_create([User(username='%s-%d' % (tag, i), is_active=True)
+                                  for i in range(options['users'])])
+        users = list(User.objects.filter(username__startswith=tag + '-'))
+        Address.objects.bulk_create([Address(user=user, receiver=tag, addr=tag, phone='13800000000')
+                                     for user in users])
+        addrs = {addr.user_id: addr for addr in Address.objects.filter(receiver=tag)}
+
+        # 每个用户的购物车中随机放入几个商品(顺序打乱)
+        carts = {}
+        pipe = conn.pipeline(transaction=False)
+        for user in users:
+            items = random.sample(sku_ids, random.randint(1, len(sku_ids)))
+            carts[user.id] = [str(sku_id) for sku_id in items]
+            pipe.hmset(cart_key_of(user), {sku_id: random.randint(1, options['max_count']) for sku_id in items})
+        pipe.execute()
+
+        # 每个用户一个已登录的测试客户端(登录不计入下单的耗时)
+        clients = {}
+        for user in users:
+            clients[user.id] = Client()
+            clients[user.id].force_login(user)
+        contention_before = conn.hgetall(CONTENTION_KEY)
+
+        def checkout(user):
+            start = time.time()
+            try:
+                result = self.post_commit(clients[user.id], addrs[user.id], carts[user.id],
+                                          options['queue_timeout'])
+            except Exception as e:
+                result = {'res': -1, 'errmsg': repr(e)}
+            finally:
+                connection.close()
+            return result['res'], time.time() - start
+
+        self.stdout.write('%d users checkout %d skus (stock %d) with %d threads ...' % (
+            len(users), len(sku_ids), options['stock'], options['concurrency']))
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(checkout, users))
+        elapsed = time.time() - start
+
+        # 检查是否超卖：卖出的数目 + 剩余库存 == 初始库存
+        sold = dict(OrderGoods.objects.filter(sku_id__in=sku_ids)
+                    .values_list('sku_id').annotate(Sum('count')).order_by())
+        stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+        oversold = [sku_id for sku_id in sku_ids
+                    if stocks[sku_id] < 0 or sold.get(sku_id, 0) + stocks[sku_id] != initial[sku_id]]
+
+        # 统计
+        latencies = sorted(cost for res, cost in results)
+        codes = {}
+        for res, cost in results:
+            codes[res] = codes.get(res, 0) + 1
+        conflicts = sum(int(count) - int(contention_before.get(field, 0))
+                        for field, count in conn.hgetall(CONTENTION_KEY).items()
+                        if field.decode().split(':')[2] in ('conflict', 'lock_timeout'))
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write('orders: %d  results: %s' % (codes.get(5, 0), codes))
+        self.stdout.write('throughput: %.1f orders/s  %.1f requests/s' % (codes.get(5, 0) / elapsed,
+                                                                           len(results) / elapsed))
+        self.stdout.write('latency: p50 %.1f ms  p99 %.1f ms' % (percentile(0.5), percentile(0.99)))
+        self.stdout.write('conflict rate: %.3f per request' % (conflicts / len(results)))
+        for sku_id in sku_ids:
+            self.stdout.write('sku %d: sold %d + stock %d = %d' % (
+                sku_id, sold.get(sku_id, 0), stocks[sku_id], sold.get(sku_id, 0) + stocks[sku_id]))
+
+        if not options['keep']:
+            order_ids = list(OrderInfo.objects.filter(user__in=users).values_list('order_id', flat=True))
+            cancel_expiry(conn, *order_ids)
+            conn.delete(*[key for user in users for key in (cart_key_of(user), summary_key_of(cart_key_of(user)))])
+            delete_stock(conn, *sku_ids)
+            OrderInfo.objects.filter(order_id__in=order_ids).delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+            goods_type.delete()
+            goods.delete()
+
+        if oversold:
+            raise CommandError('oversold: %s' % oversold)
+        self.stdout.write(self.style.SUCCESS('no oversell'))
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0002_auto_20181126_1710'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderinfo',
+            name='order_status',
+            field=models.SmallIntegerField(choices=[(1, '待支付'), (2, '待发货'), (3, '待收获'), (4, '待评价'), (5, '已完成'), (6, '已取消')], default=1, verbose_name='支付状态'),
+        ),
+    ]
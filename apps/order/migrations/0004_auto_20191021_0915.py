@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0003_auto_20191020_1030'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='orderinfo',
+            index=models.Index(fields=['user', 'create_time'], name='df_order_user_time_idx'),
+        ),
+    ]
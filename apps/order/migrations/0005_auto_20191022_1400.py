@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('user', '0001_initial'),
+        ('goods', '0001_initial'),
+        ('order', '0004_auto_20191021_0915'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderInfoArchive',
+            fields=[
+                ('order_id', models.CharField(max_length=128, primary_key=True, serialize=False, verbose_name='订单编号')),
+                ('pay_method', models.SmallIntegerField(choices=[(1, '货到付款'), (2, '微信支付'), (3, '支付宝'), (4, '银联支付')], default=3, verbose_name='支付方式')),
+                ('total_count', models.IntegerField(default=1, verbose_name='商品数量')),
+                ('total_price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='总金额')),
+                ('transit_price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='运费')),
+                ('order_status', models.SmallIntegerField(choices=[(1, '待支付'), (2, '待发货'), (3, '待收获'), (4, '待评价'), (5, '已完成'), (6, '已取消')], default=1, verbose_name='支付状态')),
+                ('trade_no', models.CharField(default='', max_length=128, verbose_name='支付编号')),
+                ('create_time', models.DateField(verbose_name='创建时间')),
+                ('update_time', models.DateField(verbose_name='更新时间')),
+                ('is_delete', models.BooleanField(default=False, verbose_name='删除标记')),
+                ('addr', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='user.Address', verbose_name='地址')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '归档订单',
+                'verbose_name_plural': '归档订单',
+                'db_table': 'df_order_info_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderGoodsArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=1, verbose_name='商品数目')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='商品价格')),
+                ('comment', models.CharField(max_length=256, verbose_name='评论')),
+                ('create_time', models.DateField(verbose_name='创建时间')),
+                ('update_time', models.DateField(verbose_name='更新时间')),
+                ('is_delete', models.BooleanField(default=False, verbose_name='删除标记')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='order.OrderInfoArchive', verbose_name='订单')),
+                ('sku', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='goods.GoodsSKU', verbose_name='商品SKU')),
+            ],
+            options={
+                'verbose_name': '归档订单商品',
+                'verbose_name_plural': '归档订单商品',
+                'db_table': 'df_order_goods_archive',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='orderinfoarchive',
+            index=models.Index(fields=['user', 'create_time'], name='df_order_archive_user_time_idx'),
+        ),
+    ]
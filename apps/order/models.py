@@ -18,6 +18,7 @@ class OrderInfo(BaseModel):
         '3': '待收获',
         '4': '待评价',
         '5': '已完成',
+        '6': '已取消',
     }
 
 
@@ -34,6 +35,7 @@ class OrderInfo(BaseModel):
         (3, '待收获'),
         (4, '待评价'),
         (5, '已完成'),
+        (6, '已取消'),
     )
     order_id = models.CharField(max_length=128, primary_key=True, verbose_name='订单编号')
     user = models.ForeignKey('user.User', verbose_name='用户   ', on_delete=models.CASCADE)
@@ -49,6 +51,10 @@ class OrderInfo(BaseModel):
         db_table = 'df_order_info'
         verbose_name = '订单'
         verbose_name_plural = verbose_name
+        # 用户中心按时间倒序分页查询订单(innodb二级索引自带主键order_id)
+        indexes = [
+            models.Index(fields=['user', 'create_time'], name='df_order_user_time_idx'),
+        ]
 
 
 class OrderGoods(BaseModel):
@@ -63,3 +69,44 @@ class OrderGoods(BaseModel):
         db_table = 'df_order_goods'
         verbose_name = '订单商品'
         verbose_name_plural = verbose_name
+
+
+class OrderInfoArchive(models.Model):
+    '''归档订单模型类(已完成、已取消的历史订单，字段与OrderInfo相同，创建时间保留原值)'''
+    order_id = models.CharField(max_length=128, primary_key=True, verbose_name='订单编号')
+    user = models.ForeignKey('user.User', verbose_name='用户', on_delete=models.CASCADE)
+    addr = models.ForeignKey('user.Address', verbose_name='地址', on_delete=models.CASCADE)
+    pay_method = models.SmallIntegerField(choices=OrderInfo.PAY_METHOD_CHOICES, default=3, verbose_name='支付方式')
+    total_count = models.IntegerField(default=1, verbose_name='商品数量')
+    total_price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='总金额')
+    transit_price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='运费')
+    order_status = models.SmallIntegerField(choices=OrderInfo.ORDER_STATUS_CHOICES, default=1, verbose_name='支付状态')
+    trade_no = models.CharField(max_length=128, default='', verbose_name='支付编号')
+    create_time = models.DateField(verbose_name='创建时间')
+    update_time = models.DateField(verbose_name='更新时间')
+    is_delete = models.BooleanField(default=False, verbose_name='删除标记')
+
+    class Meta:
+        db_table = 'df_order_info_archive'
+        verbose_name = '归档订单'
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['user', 'create_time'], name='df_order_archive_user_time_idx'),
+        ]
+
+
+class OrderGoodsArchive(models.Model):
+    '''归档订单商品模型类'''
+    order = models.ForeignKey('OrderInfoArchive', verbose_name='订单', on_delete=models.CASCADE)
+    sku = models.ForeignKey('goods.GoodsSKU', verbose_name='商品SKU', on_delete=models.CASCADE)
+    count = models.IntegerField(default=1, verbose_name='商品数目')
+    price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='商品价格')
+    comment = models.CharField(max_length=256, verbose_name='评论')
+    create_time = models.DateField(verbose_name='创建时间')
+    update_time = models.DateField(verbose_name='更新时间')
+    is_delete = models.BooleanField(default=False, verbose_name='删除标记')
+
+    class Meta:
+        db_table = 'df_order_goods_archive'
+        verbose_name = '归档订单商品'
+        verbose_name_plural = verbose_name
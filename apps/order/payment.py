@@ -0,0 +1,354 @@
+"""
+支付宝支付
+
+支付结果以支付宝的异步通知(/order/notify)为准：验签后把订单改为已支付，
+并在redis频道 order_paid_<订单id> 上发布消息，等待支付结果的请求收到消息后立即返回
+
+通知可能丢失(用户关掉了浏览器、回调失败)，定时任务 reconcile_payments 按天分批找出待支付的订单，
+向支付平台查询交易状态，把已支付的订单一次update修改。
+查询支付平台的客户端由 settings.ORDER_PAYMENT_CLIENT 指定：AlipayClient，测试时用 StubPaymentClient
+
+订单超时取消前先关闭交易(close_trades)；订单已取消后才到达的支付通知不会修改订单，
+记到 order_refund: {订单id: 支付编号} 等待退款
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Case, When, Value, CharField
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+
+import requests
+from alipay import AliPay
+from apps.order.models import OrderInfo
+from apps.order.expiry import cancel_expiry
+
+# 支付成功的交易状态
+TRADE_PAID = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+
+# 订单已取消但收到了支付的交易，需要退款
+REFUND_KEY = 'order_refund'
+
+logger = logging.getLogger(__name__)
+
+
+class PooledAliPay(AliPay):
+    """
+    进程内共用的支付宝客户端：密钥只在创建时读取解析一次，
+    查询接口通过 requests.Session 复用到网关的http连接(sdk自带的urlopen每次都要重新建立https连接)
+    """
+
+    def __init__(self, gateway, timeout, **kwargs):
+        super(PooledAliPay, self).__init__(**kwargs)
+        self._gateway = gateway
+        self._timeout = timeout
+        self._session = requests.Session()
+
+    @property
+    def gateway(self):
+        return self._gateway
+
+    def _request(self, method, biz_content):
+        data = self.build_body(method, biz_content)
+        url = self._gateway + "?" + self.sign_data(data)
+        raw_string = self._session.get(url, timeout=self._timeout).content.decode("utf-8")
+        return self._verify_and_return_sync_response(raw_string, method.replace(".", "_") + "_response")
+
+    def api_alipay_trade_query(self, out_trade_no=None, trade_no=None):
+        biz_content = {}
+        if out_trade_no:
+            biz_content["out_trade_no"] = out_trade_no
+        if trade_no:
+            biz_content["trade_no"] = trade_no
+        return self._request("alipay.trade.query", biz_content)
+
+    def api_alipay_trade_close(self, out_trade_no=None, trade_no=None, operator_id=None):
+        biz_content = {}
+        if out_trade_no:
+            biz_content["out_trade_no"] = out_trade_no
+        if trade_no:
+            biz_content["trade_no"] = trade_no
+        if operator_id:
+            biz_content["operator_id"] = operator_id
+        return self._request("alipay.trade.close", biz_content)
+
+
+_alipay = None
+_alipay_lock = threading.Lock()
+
+
+def get_alipay():
+    """
+    获取进程内共用的支付宝客户端(第一次使用时按settings创建)
+    """
+    global _alipay
+    if _alipay is None:
+        with _alipay_lock:
+            if _alipay is None:
+                _alipay = create_alipay()
+    return _alipay
+
+
+def create_alipay():
+    # 初始化
+    with open(settings.ALIPAY_APP_PRIVATE_KEY_PATH) as f:
+        app_private_key_string = f.read()
+    with open(settings.ALIPAY_PUBLIC_KEY_PATH) as f:
+        alipay_public_key_string = f.read()
+    return PooledAliPay(
+        gateway=settings.ALIPAY_GATEWAY,
+        timeout=settings.ALIPAY_TIMEOUT,
+        appid=settings.ALIPAY_APPID,  # 应用的id
+        app_notify_url=None,  # 默认回调url
+        app_private_key_string=app_private_key_string,
+        alipay_public_key_string=alipay_public_key_string,
+        sign_type=settings.ALIPAY_SIGN_TYPE,  # RSA 或者 RSA2
+    )
+
+
+def paid_channel_of(order_id):
+    return 'order_paid_%s' % order_id
+
+
+def verify_notify(alipay, data):
+    """
+    验证支付宝异步通知的签名，返回去掉签名后的通知参数，验签失败返回None
+    """
+    data = dict(data)
+    signature = data.pop('sign', None)
+    if not signature:
+        return None
+    try:
+        if not alipay.verify(data, signature):
+            return None
+    except Exception:
+        return None
+    return data
+
+
+def pay_amount_of(order):
+    """订单的支付金额(settings.ALIPAY_PAY_AMOUNT 不为None时统一支付该金额，沙箱测试用)"""
+    if settings.ALIPAY_PAY_AMOUNT is not None:
+        return Decimal(settings.ALIPAY_PAY_AMOUNT)
+    return order.total_price + order.transit_price
+
+
+def get_notify_order(data):
+    """
+    校验验签后的通知是发给本应用的、支付金额与订单一致
+    返回通知对应的订单，校验失败返回None
+    """
+    if data.get('app_id') != settings.ALIPAY_APPID:
+        logger.warning('alipay notify for another app: app_id=%s out_trade_no=%s',
+                       data.get('app_id'), data.get('out_trade_no'))
+        return None
+
+    order = OrderInfo.objects.filter(order_id=data.get('out_trade_no')).first()
+    if order is None:
+        logger.warning('alipay notify for unknown order: out_trade_no=%s', data.get('out_trade_no'))
+        return None
+
+    try:
+        amount = Decimal(data.get('total_amount'))
+    except (TypeError, InvalidOperation):
+        amount = None
+    if amount != pay_amount_of(order):
+        logger.warning('alipay notify amount mismatch: out_trade_no=%s total_amount=%s expected=%s',
+                       order.order_id, data.get('total_amount'), pay_amount_of(order))
+        return None
+    return order
+
+
+def mark_order_paid(order_id, trade_no):
+    """
+    修改订单状态为已支付(幂等：只有待支付的订单会被修改，重复的通知不会重复处理)
+    返回是否修改了订单
+    """
+    # update df_order_info set order_status=4, trade_no=... where order_id=... and order_status=1
+    res = OrderInfo.objects.filter(order_id=order_id, order_status=1).update(order_status=4,  # 去评价
+                                                                             trade_no=trade_no)
+    if res:
+        # 通知正在等待支付结果的请求
+        conn = get_redis_connection('default')
+        conn.publish(paid_channel_of(order_id), trade_no)
+        cancel_expiry(conn, order_id)
+    return res > 0
+
+
+def flag_refund(order_id, trade_no):
+    """
+    订单已取消(超时)后才收到支付成功的通知：不修改订单，记下来等待退款
+    """
+    logger.error('payment for cancelled order, refund needed: order_id=%s trade_no=%s', order_id, trade_no)
+    get_redis_connection('default').hset(REFUND_KEY, order_id, trade_no)
+
+
+def wait_order_paid(order_id, timeout):
+    """
+    等待订单支付成功(redis 订阅/发布)，最多等待timeout秒，返回订单状态
+    """
+    conn = get_redis_connection('default')
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(paid_channel_of(order_id))
+    try:
+        # 订阅之后再查一次，避免订阅之前已经支付成功而错过消息
+        status = OrderInfo.objects.filter(order_id=order_id).values_list('order_status', flat=True).first()
+        if status != 1:
+            return status
+        # get_message 收到订阅确认时也会返回None，所以按截止时间循环读取
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return 1
+            if pubsub.get_message(timeout=remaining) is not None:
+                return 4
+    finally:
+        pubsub.close()
+
+
+class AlipayClient(object):
+    """查询支付宝的交易状态"""
+
+    def __init__(self):
+        self.alipay = get_alipay()
+
+    def query(self, order_id):
+        """已支付返回支付编号，未支付返回None，查询失败抛出异常"""
+        result = self.alipay.api_alipay_trade_query(out_trade_no=order_id)
+        if result.get('code') == '10000' and result.get('trade_status') in TRADE_PAID:
+            return result.get('trade_no')
+        return None
+
+    def close(self, order_id):
+        """
+        关闭交易(关闭后不能再支付)
+        已关闭 或 交易不存在(没有打开过支付页面) 返回None，已支付返回支付编号，关闭失败抛出异常
+        """
+        result = self.alipay.api_alipay_trade_close(out_trade_no=order_id)
+        if result.get('code') == '10000' or result.get('sub_code') == 'ACQ.TRADE_NOT_EXIST':
+            return None
+        if result.get('sub_code') == 'ACQ.TRADE_STATUS_ERROR':
+            # 交易已支付 或 已关闭，不能关闭
+            return self.query(order_id)
+        raise RuntimeError('close trade %s failed: %s' % (order_id, result))
+
+
+class StubPaymentClient(object):
+    """本地测试用：paid中的订单视为已支付 {订单id: 支付编号}"""
+
+    def __init__(self, paid=None):
+        self.paid = dict(paid or {})
+
+    def query(self, order_id):
+        return self.paid.get(order_id)
+
+    def close(self, order_id):
+        return self.paid.get(order_id)
+
+
+def get_payment_client():
+    return import_string(settings.ORDER_PAYMENT_CLIENT)()
+
+
+def _query_with_backoff(client, order_id, retries, backoff):
+    """
+    查询交易状态，失败后按 backoff, backoff*2, backoff*4... 秒重试
+    返回 (是否查询成功, 支付编号)
+    """
+    for i in range(retries):
+        try:
+            return True, client.query(order_id)
+        except Exception:
+            if i == retries - 1:
+                return False, None
+            time.sleep(backoff * 2 ** i)
+
+
+def close_trades(client, order_ids, workers=8):
+    """
+    订单超时取消前关闭支付平台上的交易，最多用workers个线程并发
+    返回 (可以取消的订单id列表, 已经支付的订单 {订单id: 支付编号}, 关闭失败的订单id列表)
+    """
+    def close(order_id):
+        try:
+            return True, client.close(order_id)
+        except Exception:
+            logger.exception('close trade failed: order_id=%s', order_id)
+            return False, None
+
+    closed, paid, failed = [], {}, []
+    if not order_ids:
+        return closed, paid, failed
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for order_id, (ok, trade_no) in zip(order_ids, executor.map(close, order_ids)):
+            if not ok:
+                failed.append(order_id)
+            elif trade_no:
+                paid[order_id] = trade_no
+            else:
+                closed.append(order_id)
+    return closed, paid, failed
+
+
+def mark_orders_paid(paid):
+    """
+    一次update修改多个订单为已支付 {订单id: 支付编号}
+    update df_order_info set order_status=4, trade_no=case order_id when ... end
+    where order_id in (...) and order_status=1
+    """
+    res = OrderInfo.objects.filter(order_id__in=list(paid.keys()), order_status=1).update(
+        order_status=4,
+        trade_no=Case(*[When(order_id=order_id, then=Value(trade_no)) for order_id, trade_no in paid.items()],
+                      default=Value(''), output_field=CharField()))
+
+    # 通知正在等待支付结果的请求
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    for order_id, trade_no in paid.items():
+        pipe.publish(paid_channel_of(order_id), trade_no)
+    pipe.execute()
+    cancel_expiry(conn, *paid.keys())
+    return res
+
+
+def reconcile_payments(client=None, days=3, batch_size=200, workers=8, retries=3, backoff=0.5):
+    """
+    核对最近days天待支付的订单：按创建日期分桶，每个桶内按订单id分批，
+    每批最多用workers个线程并发查询支付平台，已支付的订单一次update修改
+    返回统计数据
+    """
+    if client is None:
+        client = get_payment_client()
+
+    stats = {'batches': 0, 'checked': 0, 'paid': 0, 'updated': 0, 'failed': 0, 'seconds': 0.0}
+    today = date.today()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for offset in range(days, -1, -1):
+            day = today - timedelta(days=offset)
+            last_id = ''
+            while True:
+                order_ids = list(OrderInfo.objects.filter(order_status=1, create_time=day, order_id__gt=last_id)
+                                 .order_by('order_id').values_list('order_id', flat=True)[:batch_size])
+                if not order_ids:
+                    break
+                last_id = order_ids[-1]
+
+                start = time.time()
+                results = list(executor.map(lambda order_id: _query_with_backoff(client, order_id, retries, backoff),
+                                            order_ids))
+                paid = {order_id: trade_no for order_id, (ok, trade_no) in zip(order_ids, results) if trade_no}
+                updated = mark_orders_paid(paid) if paid else 0
+
+                stats['batches'] += 1
+                stats['checked'] += len(order_ids)
+                stats['paid'] += len(paid)
+                stats['updated'] += updated
+                stats['failed'] += sum(1 for ok, trade_no in results if not ok)
+                stats['seconds'] += time.time() - start
+    return stats
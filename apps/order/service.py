@@ -0,0 +1,376 @@
+"""
+下单业务(不依赖request，web视图和celery下单worker共用)
+
+commit_order  创建订单，返回跟 /order/commit 相同的应答字典
+排队下单(settings.ORDER_QUEUED_CHECKOUT)时，视图只生成一个排队号，
+下单结果由worker写回redis：order_ticket_<排队号> -> json
+同一个幂等键(idempotency_key)重复提交时直接返回第一次的结果：order_idem_<用户id>_<幂等键> -> json
+每个商品的冲突、重试次数：order_contention {策略:sku_id:conflict|retry|lock_wait_ms|lock_timeout: 次数}
+"""
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction, connection, OperationalError
+from django.db.models import Q, F, Case, When, IntegerField
+from django_redis import get_redis_connection
+
+from utils.snowflake import next_order_id
+from utils.transaction import safe_on_commit
+from apps.goods.models import GoodsSKU
+from apps.order.models import OrderInfo, OrderGoods
+from apps.cart.operations import cart_key_of, cart_delete
+from apps.goods.stock import adjust_stock, reserve_stock, confirm_reservation, release_reservation
+from apps.order.expiry import schedule_expiry
+from apps.goods.sales import record_sales, buffer_sales
+
+# 排队号在redis中保留的时间(秒)
+TICKET_TTL = 3600
+
+# 下单策略
+STRATEGIES = ('pessimistic', 'optimistic', 'reservation')
+
+# 各下单策略在每个商品上的冲突、重试次数
+CONTENTION_KEY = 'order_contention'
+
+
+def ticket_key_of(ticket):
+    return 'order_ticket_%s' % ticket
+
+
+def create_ticket(conn, user_id):
+    """生成排队号，状态为排队中"""
+    ticket = uuid.uuid4().hex
+    conn.set(ticket_key_of(ticket),
+             json.dumps({'user': user_id, 'res': 8, 'errmsg': '排队中'}),
+             ex=TICKET_TTL)
+    return ticket
+
+
+def set_ticket_result(conn, ticket, user_id, result):
+    """写回下单结果"""
+    value = dict(result, user=user_id)
+    conn.set(ticket_key_of(ticket), json.dumps(value), ex=TICKET_TTL)
+
+
+def get_ticket(conn, ticket, user_id):
+    """
+    查询排队号的状态，排队号不存在或不属于该用户时返回None
+    """
+    value = conn.get(ticket_key_of(ticket))
+    if value is None:
+        return None
+    result = json.loads(value)
+    if result.pop('user') != user_id:
+        return None
+    return result
+
+
+def idempotency_key_of(user_id, key):
+    return 'order_idem_%d_%s' % (user_id, key)
+
+
+def run_idempotent(conn, user_id, key, func):
+    """
+    同一用户的同一个幂等键只执行一次func：
+    第一次提交先写入处理中的标记(set nx，settings.ORDER_IDEMPOTENCY_PENDING_TTL 秒后过期，
+    处理的进程中途退出时不会长时间挡住重试)再执行，成功的结果保存 settings.ORDER_IDEMPOTENCY_TTL 秒；
+    重复的提交直接返回保存的结果，第一次还在处理时等待它的结果，不会同时进入mysql事务
+    失败的结果不保存，用户修改后可以用同一个键重新提交
+    """
+    redis_key = idempotency_key_of(user_id, key)
+    if conn.set(redis_key, '', nx=True, ex=settings.ORDER_IDEMPOTENCY_PENDING_TTL):
+        try:
+            result = func()
+        except Exception:
+            conn.delete(redis_key)
+            raise
+        if result['res'] in (5, 8):
+            # 创建成功 或 排队中
+            conn.set(redis_key, json.dumps(result), ex=settings.ORDER_IDEMPOTENCY_TTL)
+        else:
+            conn.delete(redis_key)
+        return result
+
+    # 重复的提交：等待第一次提交的结果
+    deadline = time.time() + settings.ORDER_IDEMPOTENCY_WAIT
+    while True:
+        value = conn.get(redis_key)
+        if value is None:
+            # 第一次提交失败了，重新执行
+            return run_idempotent(conn, user_id, key, func)
+        if value:
+            return json.loads(value)
+        if time.time() >= deadline:
+            return {'res': 10, 'errmsg': '订单正在处理中'}
+        time.sleep(0.05)
+
+
+def record_contention(conn, strategy, contention):
+    """
+    累加每个商品的冲突、重试次数 contention: {(sku_id, 类型): 次数}
+    order_contention: {策略:sku_id:类型: 次数}，按商品的热度选择下单策略的依据
+    """
+    if not contention:
+        return
+    pipe = conn.pipeline(transaction=False)
+    for (sku_id, kind), count in contention.items():
+        pipe.hincrby(CONTENTION_KEY, '%s:%s:%s' % (strategy, sku_id, kind), count)
+    pipe.execute()
+
+
+def get_contention(conn):
+    """
+    读取冲突统计 {策略: {sku_id: {类型: 次数}}}
+    """
+    stats = {}
+    for field, count in conn.hgetall(CONTENTION_KEY).items():
+        strategy, sku_id, kind = field.decode().split(':')
+        stats.setdefault(strategy, {}).setdefault(int(sku_id), {})[kind] = int(count)
+    return stats
+
+
+def commit_order(user, addr, pay_method, sku_ids, strategy=None):
+    """
+    创建订单，策略由 settings.ORDER_COMMIT_STRATEGY 指定：
+    pessimistic  悲观锁：一条 select ... order by id for update 锁住全部商品再扣库存
+    optimistic   乐观锁：update ... where stock=查询时的库存，冲突时回滚事务，随机退避后重新执行整个事务
+    reservation  秒杀：先在redis库存镜像中预扣库存，抢到库存的请求才进入mysql事务(乐观锁扣库存)
+    """
+    if strategy is None:
+        strategy = settings.ORDER_COMMIT_STRATEGY
+    if strategy not in STRATEGIES:
+        raise ImproperlyConfigured('ORDER_COMMIT_STRATEGY must be one of %s' % ', '.join(STRATEGIES))
+
+    conn = get_redis_connection('default')
+    cart_key = cart_key_of(user)
+
+    # 从redis中获取用户所要购买的商品的数量(一次 hmget)
+    try:
+        counts = {int(sku_id): int(count)
+                  for sku_id, count in zip(sku_ids, conn.hmget(cart_key, sku_ids))}
+    except (TypeError, ValueError):
+        # 购物车中没有该商品
+        return {'res': 4, 'errmsg': '商品不存在'}
+
+    contention = Counter()
+    reservation = None
+    try:
+        # 秒杀：预扣库存(一次往返)，库存不足的请求直接返回，不占用数据库连接
+        if strategy == 'reservation':
+            reservation, error_sku_id = reserve_stock(conn, counts)
+            if reservation is None:
+                contention[(error_sku_id, 'conflict')] += 1
+                return {'res': 6, 'errmsg': '商品库存不足'}
+
+        try:
+            result = create_order_with_retry(user, addr, pay_method, sku_ids, counts, conn, cart_key,
+                                             strategy, reservation, contention)
+        except LockTimeout:
+            # 等锁超时，事务已经回滚，客户端可以稍后重试
+            result = {'res': 11, 'errmsg': '抢购的人太多了，请稍后重试', 'retry': True}
+        except Exception:
+            # 事务提交失败，归还预扣的库存
+            if reservation:
+                release_reservation(conn, reservation)
+            raise
+
+        if reservation and result['res'] != 5:
+            # 下单失败，归还预扣的库存
+            release_reservation(conn, reservation)
+
+        return result
+    finally:
+        record_contention(conn, strategy, contention)
+
+
+class LockTimeout(Exception):
+    """悲观锁等锁超时(或死锁被mysql回滚)，可以重试"""
+
+
+class StockConflict(Exception):
+    """乐观锁更新库存时有商品的库存被别人修改了，stocks: 本次事务查询到的库存 {sku_id: 库存}"""
+
+    def __init__(self, stocks):
+        super(StockConflict, self).__init__(stocks)
+        self.stocks = stocks
+
+
+def create_order_with_retry(user, addr, pay_method, sku_ids, counts, conn, cart_key, strategy, reservation,
+                            contention):
+    """
+    创建订单，乐观锁库存冲突时整个事务回滚，随机退避后重新执行(退避时不持有任何行锁)，
+    最多执行 settings.ORDER_COMMIT_RETRIES 次，最后一次冲突直接返回失败
+    """
+    retries = max(settings.ORDER_COMMIT_RETRIES, 1)
+    for i in range(retries):
+        try:
+            return create_order(user, addr, pay_method, sku_ids, counts, conn, cart_key,
+                                strategy, reservation, contention)
+        except StockConflict as e:
+            if i == retries - 1:
+                # 重试次数用完了
+                return {'res': 7, 'errmsg': '下单失败2'}
+
+            # 事务已回滚，重新查询库存(不加锁)：记录冲突的商品，库存不足时不再重试
+            stocks = dict(GoodsSKU.objects.filter(id__in=list(counts.keys())).values_list('id', 'stock'))
+            for sku_id, count in counts.items():
+                if stocks.get(sku_id) != e.stocks[sku_id]:
+                    contention[(sku_id, 'conflict')] += 1
+                contention[(sku_id, 'retry')] += 1
+                if count > stocks.get(sku_id, 0):
+                    return {'res': 6, 'errmsg': '商品库存不足'}
+            time.sleep(random.uniform(0, settings.ORDER_COMMIT_BACKOFF * 2 ** i))
+
+
+def lock_skus(counts, contention):
+    """
+    悲观锁：一条 select ... where id in (...) order by id for update 锁住全部商品
+    所有请求都按id从小到大加锁，购物车中商品的顺序不同也不会互相死锁
+    等锁最多 settings.ORDER_LOCK_WAIT_TIMEOUT 秒，超时抛出LockTimeout
+    (只对这一条语句生效，之后恢复连接原来的设置，持久连接上别的 select ... for update 不受影响)
+    等锁超过10毫秒给每个商品记一次冲突，lock_wait_ms 累加等待的时间
+    """
+    mysql = connection.vendor == 'mysql'
+    if mysql:
+        with connection.cursor() as cursor:
+            cursor.execute('SET @old_lock_wait_timeout = @@SESSION.innodb_lock_wait_timeout, '
+                           'SESSION innodb_lock_wait_timeout = %s', [settings.ORDER_LOCK_WAIT_TIMEOUT])
+
+    start = time.time()
+    try:
+        skus = {sku.id: sku for sku in
+                GoodsSKU.objects.select_for_update().filter(id__in=list(counts.keys())).order_by('id')}
+    except OperationalError as e:
+        # 1205 等锁超时  1213 死锁
+        if e.args and e.args[0] in (1205, 1213):
+            for sku_id in counts:
+                contention[(sku_id, 'lock_timeout')] += 1
+            raise LockTimeout(e)
+        raise
+    finally:
+        if mysql:
+            with connection.cursor() as cursor:
+                cursor.execute('SET SESSION innodb_lock_wait_timeout = @old_lock_wait_timeout')
+    wait_ms = int((time.time() - start) * 1000)
+    if wait_ms > 10:
+        for sku_id in skus:
+            contention[(sku_id, 'conflict')] += 1
+            contention[(sku_id, 'lock_wait_ms')] += wait_ms
+    return skus
+
+
+@transaction.atomic  # Django自带的 事务 装饰器（创建 事务）
+def create_order(user, addr, pay_method, sku_ids, counts, conn, cart_key, strategy, reservation, contention):
+    # 创建订单核心业务
+    # 语句数目与商品条数无关：一次查询商品，一条insert订单，一条insert订单商品，一条update库存
+
+    # 组织参数
+    # 订单id：snowflake id(按时间递增，多进程多主机下不重复)
+    order_id = next_order_id()
+
+    # 运费
+    transit_price = 10
+
+    # 获取全部商品的信息(悲观锁时同时锁住商品)
+    if strategy == 'pessimistic':
+        skus = lock_skus(counts, contention)
+    else:
+        skus = GoodsSKU.objects.in_bulk(list(counts.keys()))
+    if len(skus) != len(counts):
+        return {'res': 4, 'errmsg': '商品不存在'}
+
+    # 判断商品的库存（别人可能比你先提交订单）
+    for sku_id, count in counts.items():
+        if count > skus[sku_id].stock:
+            return {'res': 6, 'errmsg': '商品库存不足'}
+
+    # 计算订单商品的 总数目 和 总金额
+    total_count = sum(counts.values())
+    total_price = sum(skus[sku_id].price * count for sku_id, count in counts.items())
+
+    # 设置事务保存点
+    save_id = transaction.savepoint()
+
+    try:
+        # 向df_order_info表中添加一条订单信息(总数目 总金额 一次写入)
+        order = OrderInfo.objects.create(order_id=order_id,
+                                         user=user,
+                                         addr=addr,
+                                         pay_method=pay_method,
+                                         total_count=total_count,
+                                         total_price=total_price,
+                                         transit_price=transit_price)
+
+        # 向df_order_goods表中一次加入全部的订单商品记录
+        OrderGoods.objects.bulk_create([OrderGoods(order=order,
+                                                   sku=skus[sku_id],
+                                                   count=count,
+                                                   price=skus[sku_id].price)
+                                        for sku_id, count in counts.items()])
+
+        # 更新商品的库存(放在最后，尽量缩短热点商品行锁的持有时间)
+        if strategy == 'pessimistic':
+            # 商品已经锁住，库存不会被别人修改
+            update_stock(skus, counts, check=False)
+        elif not update_stock(skus, counts):
+            # 有商品的库存被别人修改了：回滚整个事务(释放已经锁住的行)，由 create_order_with_retry 退避后重新执行
+            raise StockConflict({sku_id: skus[sku_id].stock for sku_id in counts})
+    except StockConflict:
+        raise
+    except Exception as e:
+        transaction.savepoint_rollback(save_id)
+        return {'res': 7, 'errmsg': '下单失败'}
+
+    # 提交 事务
+    transaction.savepoint_commit(save_id)
+
+    # 事务提交后同步redis中的库存镜像(秒杀模式下预扣的库存正式扣除)
+    # 提交后的操作失败只记录日志，不影响已经创建的订单(库存镜像、销量由定时任务对账)
+    if reservation:
+        safe_on_commit(lambda: confirm_reservation(conn, reservation))
+    else:
+        stock_deltas = {sku_id: -count for sku_id, count in counts.items()}
+        safe_on_commit(lambda: adjust_stock(conn, stock_deltas))
+
+    # 超时未支付的订单自动取消，归还库存
+    safe_on_commit(lambda: schedule_expiry(conn, order_id))
+
+    # 累加商品的销量(延迟写回mysql) 和 每日销量汇总
+    sales = {sku_id: (count, skus[sku_id].price * count) for sku_id, count in counts.items()}
+    safe_on_commit(lambda: buffer_sales(conn, counts))
+    safe_on_commit(lambda: record_sales(order.create_time, sales))
+
+    # 删除用户购物车中对应的记录
+    cart_delete(conn, cart_key, *sku_ids)
+
+    return {'res': 5, 'errmsg': '创建成功', 'order_id': order_id}
+
+
+def update_stock(skus, counts, check=True):
+    """
+    一条update语句更新全部商品的库存(销量在事务提交后累加到redis，定时写回，不在这里修改)
+    update df_goods_sku set stock=case ... end
+    where (id=1 and stock=查询时的库存) or (id=2 and stock=查询时的库存) ...
+    check为True时是乐观锁：有商品的库存跟查询时不一样则撤销本次更新，返回False
+    """
+    if check:
+        condition = Q()
+        for sku_id in counts:
+            condition |= Q(id=sku_id, stock=skus[sku_id].stock)
+    else:
+        condition = Q(id__in=list(counts.keys()))
+
+    sid = transaction.savepoint()
+    res = GoodsSKU.objects.filter(condition).update(
+        stock=Case(*[When(id=sku_id, then=F('stock') - count) for sku_id, count in counts.items()],
+                   default=F('stock'), output_field=IntegerField()))
+    if res != len(counts):
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
@@ -1,3 +1,182 @@
-from django.test import TestCase
+import random
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest import mock, skipUnless
+
+from Cryptodome.PublicKey import RSA
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django_redis import get_redis_connection
+
+from apps.cart.operations import cart_key_of, summary_key_of
+from apps.goods.factories import create_skus
+from apps.goods.models import GoodsSKU
+from apps.goods.sales import SALES_DELTA_KEY
+from apps.goods.stock import delete_stock
+from apps.order.expiry import cancel_expiry
+from apps.order.models import OrderInfo, OrderGoods
+from apps.order.payment import PooledAliPay, pay_amount_of
+from apps.order.service import commit_order
+from apps.user.models import User, Address
 
 # Create your tests here.
+
+
+class OrderPlaceViewTest(TestCase):
+    """提交订单页面的数据库查询次数与购买的商品条数无关"""
+
+    def setUp(self):
+        self.skus = create_skus(5)
+        self.user = User.objects.create_user('order_test', 'order_test@example.com', 'password')
+        Address.objects.create(user=self.user, receiver='张三', addr='北京市', phone='13800000000', is_default=True)
+        self.client.force_login(self.user)
+
+        self.conn = get_redis_connection('default')
+        self.cart_key = cart_key_of(self.user)
+        self.conn.hmset(self.cart_key, {sku.id: 2 for sku in self.skus})
+
+    def tearDown(self):
+        self.conn.delete(self.cart_key, summary_key_of(self.cart_key))
+
+    def test_queries_do_not_grow_with_order_lines(self):
+        with CaptureQueriesContext(connection) as one_line:
+            response = self.client.post(reverse('order:place'), {'sku_ids': [self.skus[0].id]})
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(len(one_line.captured_queries)):
+            response = self.client.post(reverse('order:place'), {'sku_ids': [sku.id for sku in self.skus]})
+        self.assertEqual(len(response.context['skus']), len(self.skus))
+        self.assertEqual(response.context['total_count'], 2 * len(self.skus))
+
+
+class OrderNotifyViewTest(TestCase):
+    """用本地生成的密钥对签名支付宝异步通知(代替支付宝网关)"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        key = RSA.generate(2048)
+        # 测试时"支付宝"和应用使用同一对密钥：用私钥签名通知，用公钥验签
+        cls.alipay = PooledAliPay(gateway=settings.ALIPAY_GATEWAY, timeout=settings.ALIPAY_TIMEOUT,
+                                  appid=settings.ALIPAY_APPID, app_notify_url=None,
+                                  app_private_key_string=key.export_key().decode(),
+                                  alipay_public_key_string=key.publickey().export_key().decode(),
+                                  sign_type=settings.ALIPAY_SIGN_TYPE)
+
+    def setUp(self):
+        self.user = User.objects.create_user('notify_test', 'notify_test@example.com', 'password')
+        addr = Address.objects.create(user=self.user, receiver='张三', addr='北京市', phone='13800000000')
+        self.order = OrderInfo.objects.create(order_id='0000000000000000001', user=self.user, addr=addr,
+                                              pay_method=3, total_count=1, total_price=20, transit_price=10)
+        patcher = mock.patch('apps.order.views.get_alipay', return_value=self.alipay)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def notify(self, **kwargs):
+        data = {
+            'app_id': settings.ALIPAY_APPID,
+            'out_trade_no': self.order.order_id,
+            'trade_no': '2019010122001400000000000001',
+            'trade_status': 'TRADE_SUCCESS',
+            'total_amount': str(pay_amount_of(self.order)),
+            'sign_type': settings.ALIPAY_SIGN_TYPE,
+        }
+        data.update(kwargs)
+        unsigned = dict(data)
+        unsigned.pop('sign_type')
+        message = '&'.join('{}={}'.format(k, v) for k, v in self.alipay._ordered_data(unsigned))
+        data['sign'] = self.alipay._sign(message)
+        return data
+
+    def order_status(self):
+        return OrderInfo.objects.get(order_id=self.order.order_id).order_status
+
+    def test_signed_notify_marks_order_paid(self):
+        response = self.client.post(reverse('order:notify'), self.notify())
+        self.assertEqual(response.content, b'success')
+        self.assertEqual(self.order_status(), 4)
+
+        # 重复的通知直接返回success
+        response = self.client.post(reverse('order:notify'), self.notify())
+        self.assertEqual(response.content, b'success')
+
+    def test_bad_signature_is_rejected(self):
+        data = self.notify()
+        data['trade_no'] = 'forged'
+        response = self.client.post(reverse('order:notify'), data)
+        self.assertEqual(response.content, b'failure')
+        self.assertEqual(self.order_status(), 1)
+
+    def test_other_app_is_rejected(self):
+        response = self.client.post(reverse('order:notify'), self.notify(app_id='2016000000000000'))
+        self.assertEqual(response.content, b'failure')
+        self.assertEqual(self.order_status(), 1)
+
+    def test_wrong_amount_is_rejected(self):
+        response = self.client.post(reverse('order:notify'), self.notify(total_amount='999.99'))
+        self.assertEqual(response.content, b'failure')
+        self.assertEqual(self.order_status(), 1)
+
+
+@skipUnless(connection.vendor == 'mysql', '行锁和死锁检测需要mysql')
+class PessimisticLockTest(TransactionTestCase):
+    """悲观锁：购物车中商品的顺序打乱，并发下单也不会互相死锁"""
+
+    users = 16
+    orders_per_user = 3
+
+    def setUp(self):
+        self.skus = create_skus(4, stock=1000)
+        self.sku_ids = [sku.id for sku in self.skus]
+        self.conn = get_redis_connection('default')
+        self.buyers = []
+        for i in range(self.users):
+            user = User.objects.create_user('lock_test_%d' % i, 'lock_test_%d@example.com' % i, 'password')
+            addr = Address.objects.create(user=user, receiver='张三', addr='北京市', phone='13800000000')
+            self.buyers.append((user, addr))
+
+    def tearDown(self):
+        order_ids = list(OrderInfo.objects.values_list('order_id', flat=True))
+        cancel_expiry(self.conn, *order_ids)
+        delete_stock(self.conn, *self.sku_ids)
+        self.conn.hdel(SALES_DELTA_KEY, *self.sku_ids)
+        self.conn.delete(*[key for user, addr in self.buyers
+                           for key in (cart_key_of(user), summary_key_of(cart_key_of(user)))])
+
+    def checkout(self, buyer):
+        user, addr = buyer
+        results = []
+        try:
+            for i in range(self.orders_per_user):
+                # 每一单都打乱购物车中商品的顺序
+                sku_ids = random.sample(self.sku_ids, len(self.sku_ids))
+                self.conn.hmset(cart_key_of(user), {sku_id: 1 for sku_id in sku_ids})
+                results.append(commit_order(user, addr, 3, [str(sku_id) for sku_id in sku_ids], 'pessimistic'))
+        finally:
+            connection.close()
+        return results
+
+    def test_shuffled_carts_do_not_deadlock(self):
+        with ThreadPoolExecutor(max_workers=self.users) as executor:
+            results = [result for results in executor.map(self.checkout, self.buyers) for result in results]
+
+        # 没有等锁超时 或 死锁(res 11)，全部下单成功
+        self.assertEqual([result['res'] for result in results], [5] * len(results))
+        total = self.users * self.orders_per_user
+        for sku in GoodsSKU.objects.filter(id__in=self.sku_ids):
+            self.assertEqual(sku.stock, 1000 - total)
+        self.assertEqual(OrderGoods.objects.count(), total * len(self.sku_ids))
+
+
+class StressCheckoutTest(TransactionTestCase):
+    """下单压力测试命令：少量用户通过 /order/commit 并发抢购，不会超卖"""
+
+    def test_no_oversell(self):
+        out = StringIO()
+        # 超卖时命令抛出 CommandError
+        call_command('stress_checkout', skus=2, stock=5, users=12, concurrency=4, stdout=out)
+        self.assertIn('no oversell', out.getvalue())
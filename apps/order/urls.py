@@ -1,10 +1,12 @@
 from django.urls import path
-from apps.order.views import OrderPlaceView, OrderCommitView, OrderPayView, OrderCheckView, CommentView
+from apps.order.views import OrderPlaceView, OrderCommitView, OrderStatusView, OrderPayView, OrderNotifyView, OrderCheckView, CommentView
 
 urlpatterns = [
     path('place', OrderPlaceView.as_view(), name='place'),  # 显示提交订单页面
     path('commit', OrderCommitView.as_view(), name='commit'),  # 执行提交订单操作
+    path('status/<ticket>', OrderStatusView.as_view(), name='status'),  # 查询排队下单的结果
     path('pay', OrderPayView.as_view(), name='pay'),  # 订单支付
+    path('notify', OrderNotifyView.as_view(), name='notify'),  # 支付宝异步通知
     path('check', OrderCheckView.as_view(), name='ckeck'),  # 查询支付结果
     path('comment/<order_id>', CommentView.as_view(), name='comment'),  # 订单评论
 ]
@@ -2,19 +2,28 @@ from django.shortcuts import render, redirect
 from django.views.generic import View
 from django.urls import reverse
 from django_redis import get_redis_connection
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 from django.db import transaction
+from django.db.models import F, Case, When, Value, CharField
 from django.conf import settings
-
-from datetime import datetime
+from django.utils import timezone
 
 from utils.mixin import LoginRequiredMixin
-from apps.goods.models import GoodsSKU
 from apps.order.models import OrderInfo, OrderGoods
+from apps.cart.operations import cart_key_of, get_cart_skus
+from apps.order.service import commit_order, create_ticket, get_ticket, run_idempotent
+from apps.order.archive import get_order, get_order_skus
+from apps.order.payment import get_alipay, verify_notify, get_notify_order, mark_order_paid, wait_order_paid, \
+    pay_amount_of, flag_refund, TRADE_PAID
+from apps.order.expiry import get_expiry
 from apps.user.models import AddressManager, Address
 
-from alipay import AliPay
-import os
+from celery_tasks.tasks import commit_order as commit_order_task
+import time
+import uuid
+from datetime import datetime
 
 # Create your views here.
 # 显示提交订单页面 /order/place
@@ -36,29 +45,10 @@ class OrderPlaceView(LoginRequiredMixin, View):
             # 跳转到购物车页面
             return redirect(reverse('cart:show'))
 
-        # 获取 user用户 redis购物车的key
+        # 获取用户要购买的商品的信息 数量 小计 总件数 总价(一次 hmget + 一次数据库查询)
         conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        skus = []  # 保存 需要购买的 商品信息
-        total_count = 0  # 保存 需要购买的 商品的总件数
-        total_price = 0  # 保存 需要购买的 商品的总价
-        # 遍历sku_id 获取用户要购买的商品的信息
-        for sku_id in sku_ids:
-            # 根据商品的id获取商品的信息
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 获取用户所要购买的商品的数量
-            count = conn.hget(cart_key, sku_id)
-            # 计算商品的小计
-            amount = sku.price * int(count)
-            # 动态给 sku 增加属性 count(该商品数量) amount(小计)
-            sku.count = int(count)
-            sku.amount = amount
-            # 追加
-            skus.append(sku)
-            # 累加计算 需要购买的 商品的总件数 商品的总价
-            total_count += int(count)
-            total_price += amount
+        cart_key = cart_key_of(user)
+        skus, total_count, total_price = get_cart_skus(conn, cart_key, sku_ids)
 
         # 运费(实际开发的时候，属于一个子系统)
         transit_price = 10  # 写固定数目
@@ -78,6 +68,7 @@ class OrderPlaceView(LoginRequiredMixin, View):
             'total_pay': total_pay,
             'addrs': addrs,
             'sku_ids': sku_ids,
+            'idempotency_key': uuid.uuid4().hex,  # 本次下单的幂等键
         }
         # 使用模板
         return render(request, 'place_order.html', context)
@@ -85,10 +76,11 @@ class OrderPlaceView(LoginRequiredMixin, View):
 
 # 传递过来的参数:地址id(addr_id)  支付方式(pay_method) 用户需要购买的商品id字符串（sku_ids）
 # mysql事务：一组sql操作，要么全部执行完，要么不执行
-# 高并发  悲观锁(进程锁)在冲突较少时  乐观锁(在更新数据时，进行判断，如果库存跟之前查询的不一样，则下单失败)
-# 支付宝支付
-class OrderCommitView1(View):
-    @transaction.atomic  # Django自带的 事务 装饰器（创建 事务）
+# Django2.0+ 直接将 事务 直接改为 Read C0mmitted(读取提交内容)
+# 下单业务见 apps/order/service.py，悲观锁/乐观锁/秒杀预扣 由 settings.ORDER_COMMIT_STRATEGY 选择
+# 排队下单(settings.ORDER_QUEUED_CHECKOUT)：请求交给celery下单worker处理，web进程不再占着整个事务
+class OrderCommitView(View):
+
     def post(self, request):
         # 判断用户是否登录
         user = request.user
@@ -100,6 +92,8 @@ class OrderCommitView1(View):
         addr_id = request.POST.get('addr_id')
         pay_method = request.POST.get('pay_method')
         sku_ids = request.POST.get('sku_ids')  # 1,3,
+        # 幂等键：同一次下单的重复提交(双击、重试)使用同一个键
+        idempotency_key = request.POST.get('idempotency_key') or request.META.get('HTTP_IDEMPOTENCY_KEY')
 
         # 校验数据(数据完整性)
         if not all([addr_id, pay_method, sku_ids]):
@@ -109,226 +103,54 @@ class OrderCommitView1(View):
         if pay_method not in OrderInfo.PAY_METHODS.keys():
             return JsonResponse({'res': 2, 'errmsg': '非法的支付方式'})
 
+        # 重复的提交直接返回第一次的结果，不访问mysql
+        if idempotency_key:
+            conn = get_redis_connection('default')
+            result = run_idempotent(conn, user.id, idempotency_key[:64],
+                                    lambda: self.commit(user, addr_id, pay_method, sku_ids))
+        else:
+            result = self.commit(user, addr_id, pay_method, sku_ids)
+
+        # 返回应答
+        return JsonResponse(result)
+
+    def commit(self, user, addr_id, pay_method, sku_ids):
         # 校验地址
         try:
             addr = Address.objects.get(id=addr_id)
         except Address.DoesNotExist:
-            return JsonResponse({'res': 3, 'errmsg': '地址非法'})
-
-
-        # todo:创建订单核心业务
-
-        # 组织参数
-        # 订单id：20190303190130+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
-
-        # 运费
-        transit_price = 10
+            return {'res': 3, 'errmsg': '地址非法'}
 
-        # 总数目 和 总金额
-        total_count = 0
-        total_price = 0
+        sku_ids = sku_ids.split(',')
 
-        # 设置事务保存点
-        save_id = transaction.savepoint()
+        # 排队下单：请求放入celery的order队列，立即返回排队号，由下单worker创建订单
+        if settings.ORDER_QUEUED_CHECKOUT:
+            conn = get_redis_connection('default')
+            ticket = create_ticket(conn, user.id)
+            commit_order_task.delay(ticket, user.id, addr.id, pay_method, sku_ids)
+            return {'res': 8, 'errmsg': '排队中', 'ticket': ticket}
 
+        return commit_order(user, addr, pay_method, sku_ids)
 
-        try:
-            # todo: 向df_order_info表中添加一条订单信息
-            order = OrderInfo.objects.create(order_id=order_id,
-                                             user=user,
-                                             addr=addr,
-                                             pay_method=pay_method,
-                                             total_count=total_count,
-                                             total_price=total_price,
-                                             transit_price=transit_price)
-            # todo: 用户有几个商品就要向df_order_goods表中加入几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                # 获取商品的信息
-                try:  # 在查询商品时，就给该进程增加进程锁，只有进程释放时，才会开始下一个进程
-                    sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
-                except:
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
-
-                # 从redis中获取用户所要购买的商品的数量
-                count = conn.hget(cart_key, sku_id)
-
-                # todo: 判断商品的库存（别人可能比你先提交订单）
-                if int(count) > sku.stock:
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
-
-
-                # todo: 向df_order_goods表中加入一条记录
-                order_goods = OrderGoods.objects.create(order=order,
-                                                        sku=sku,
-                                                        count=count,
-                                                        price=sku.price)
-
-                # todo: 更新商品的库存和销量
-                sku.stock -= int(count)
-                sku.sales += int(count)
-                sku.save()
-
-                # todo: 雷家计算订单商品的 总数目 和 总金额
-                amount = sku.price * int(count)
-                total_count += int(count)
-                total_price += amount
-
-            # todo: 更新订单信息表中的 总数目 和 总金额
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
-        except Exception as e:
-            transaction.rollback(save_id)
-            return JsonResponse({'res': 7, 'errmsg': '下单成功'})
-
-        # 提交 事务
-        transaction.savepoint_commit(save_id)
-
-        # todo: 删除用户购物车中对应的记录
-        conn.hdel(cart_key, *sku_ids)
 
-        # 返回应答
-        return JsonResponse({'res': 5, 'errmsg': '创建成功'})
+# 查询排队下单的结果
+# /order/status/<ticket>
+class OrderStatusView(View):
 
-# Django2.0+ 直接将 事务 直接改为 Read C0mmitted(读取提交内容)
-# 乐观锁(在更新数据时，进行判断，如果库存跟之前查询的不一样，则下单失败)
-class OrderCommitView(View):
-    @transaction.atomic  # Django自带的 事务 装饰器（创建 事务）
-    def post(self, request):
+    def get(self, request, ticket):
         # 判断用户是否登录
         user = request.user
         if not user.is_authenticated:
             # 用户没有登录
             return JsonResponse({'res': 0, 'errmsg': '用户没有登录'})
 
-        # 接收参数
-        addr_id = request.POST.get('addr_id')
-        pay_method = request.POST.get('pay_method')
-        sku_ids = request.POST.get('sku_ids')  # 1,3,
-
-        # 校验数据(数据完整性)
-        if not all([addr_id, pay_method, sku_ids]):
-            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
-
-        # 校验支付方式
-        if pay_method not in OrderInfo.PAY_METHODS.keys():
-            return JsonResponse({'res': 2, 'errmsg': '非法的支付方式'})
-
-        # 校验地址
-        try:
-            addr = Address.objects.get(id=addr_id)
-        except Address.DoesNotExist:
-            return JsonResponse({'res': 3, 'errmsg': '地址非法'})
-
-
-        # todo:创建订单核心业务
-
-        # 组织参数
-        # 订单id：20190303190130+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
-
-        # 运费
-        transit_price = 10
-
-        # 总数目 和 总金额
-        total_count = 0
-        total_price = 0
-
-        # 设置事务保存点
-        save_id = transaction.savepoint()
-
-
-        try:
-            # todo: 向df_order_info表中添加一条订单信息
-            order = OrderInfo.objects.create(order_id=order_id,
-                                             user=user,
-                                             addr=addr,
-                                             pay_method=pay_method,
-                                             total_count=total_count,
-                                             total_price=total_price,
-                                             transit_price=transit_price)
-            # todo: 用户有几个商品就要向df_order_goods表中加入几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                for i in range(3):  # 尝试3次下单
-                    # 获取商品的信息
-                    try:
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except:
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
-
-                    # 从redis中获取用户所要购买的商品的数量
-                    count = conn.hget(cart_key, sku_id)
-
-                    # todo: 判断商品的库存（别人可能比你先提交订单,库存可能会在这里改变）
-                    if int(count) > int(sku.stock):
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
-
-
-                    # todo: 更新商品的库存和销量
-                    orgin_stock = sku.stock
-                    new_stock = orgin_stock - int(count)
-                    new_sales = sku.sales + int(count)
-
-                    # print('user:%d time:%d stock:%d' % (user.id, i, sku.stock))
-                    # import time
-                    # time.sleep(10)
-
-                    # update df_goods_sku set stock=new_stock,sales=new_sales
-                    # where id=sku_id and stock = orgin_stock
-                    # 返回受影响的行数(此条语句只影响一行，要么返回1【成功】，要么返回0【失败】)
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=orgin_stock).update(stock=new_stock, sales=new_sales)
-                    if res == 0:
-                        if i == 2:
-                            # 尝试的第3次
-                            transaction.savepoint_rollback(save_id)
-                            return JsonResponse({'res': 7, 'errmsg': '下单失败2'})
-                        continue
-
-                    # 将下面的尝试代码移动到写入记录前面，防止重复记录
-                    # todo: 向df_order_goods表中加入一条记录
-                    OrderGoods.objects.create(order=order,
-                                              sku=sku,
-                                              count=count,
-                                              price=sku.price)
-
-
-                    # todo: 雷家计算订单商品的 总数目 和 总金额
-                    amount = sku.price * int(count)
-                    total_count += int(count)
-                    total_price += amount
-
-                    # 跳出循环
-                    break
-
-            # todo: 更新订单信息表中的 总数目 和 总金额
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
-        except Exception as e:
-            transaction.rollback(save_id)
-            return JsonResponse({'res': 7, 'errmsg': '下单成功'})
-
-        # 提交 事务
-        transaction.savepoint_commit(save_id)
-
-        # todo: 删除用户购物车中对应的记录
-        conn.hdel(cart_key, *sku_ids)
+        conn = get_redis_connection('default')
+        result = get_ticket(conn, ticket, user.id)
+        if result is None:
+            return JsonResponse({'res': 9, 'errmsg': '排队号不存在'})
 
-        # 返回应答
-        return JsonResponse({'res': 5, 'errmsg': '创建成功'})
+        # 返回应答(还在排队时res为8)
+        return JsonResponse(result)
 
 
 # 订单支付
@@ -358,33 +180,63 @@ class OrderPayView(View):
         except OrderInfo.DoesNotExist:
             return JsonResponse({'res': 1, 'errmsg': '订单错误'})
 
+        # 交易的绝对超时时间 = 订单超时取消的时间(支付宝从收到支付请求开始计算timeout_express，不能用相对时间)
+        # 离取消不到 settings.ORDER_PAY_MIN_SECONDS 秒的订单不再发起支付
+        pay_options = {'timeout_express': '%dm' % (settings.ORDER_PAY_TIMEOUT // 60)}
+        deadline = get_expiry(get_redis_connection('default'), order_id)
+        if deadline is not None:
+            if deadline - time.time() < settings.ORDER_PAY_MIN_SECONDS:
+                return JsonResponse({'res': 2, 'errmsg': '订单即将超时取消，请重新下单'})
+            expire_at = timezone.localtime(datetime.fromtimestamp(deadline, timezone.utc))
+            pay_options = {'time_expire': expire_at.strftime('%Y-%m-%d %H:%M:%S')}
+
         # 业务处理：调用python sdk 使用支付宝支付订单
         # 初始化
-        alipay = AliPay(
-            appid='2016092500595996',  # 应用的id
-            app_notify_url=None,  # 默认回调url
-            app_private_key_path=os.path.join(settings.BASE_DIR, "apps/order/app_private_key.pem"),
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥
-            alipay_public_key_path=os.path.join(settings.BASE_DIR, "apps/order/alipay_public_key.pem"),
-            sign_type="RSA2",  # RSA 或者 RSA2
-            debug=True  # 默认False  配合沙箱模式使用
-            )
+        alipay = get_alipay()
 
         # 调用电脑支付接口
         # 电脑网站支付，需要跳转到https://openapi.alipay.com/gateway.do? + order_string
-        total_pay = order.total_price + order.transit_price  # 实际支付总金额
         order_string = alipay.api_alipay_trade_page_pay(
             out_trade_no=order_id,  # 订单id
-            total_amount=str(0.01),  # 支付总金额
+            total_amount=str(pay_amount_of(order)),  # 支付总金额(异步通知时核对)
             subject="天天生鲜 %s" % order_id,
             return_url=None,  #
-            notify_url=None  # 可选, 不填则使用默认notify url
+            notify_url=request.build_absolute_uri(reverse('order:notify')),  # 支付宝异步通知支付结果
+            **pay_options  # 订单超时取消后不能再支付
         )
         # 返回应答
-        pay_url = 'https://openapi.alipaydev.com/gateway.do?' + order_string
+        pay_url = alipay.gateway + '?' + order_string
         return JsonResponse({'res': 3, 'pay_url': pay_url})
 
-# 查询订单结果。。
+# 支付宝异步通知支付结果
+# /order/notify
+@method_decorator(csrf_exempt, name='dispatch')
+class OrderNotifyView(View):
+
+    def post(self, request):
+        # 验证签名(通知参数是支付宝用自己的私钥签名的)
+        data = verify_notify(get_alipay(), request.POST.dict())
+        if data is None:
+            return HttpResponse('failure')
+
+        # 只处理发给本应用、金额与订单一致的通知
+        order = get_notify_order(data)
+        if order is None:
+            return HttpResponse('failure')
+
+        # 修改 OrderInfo 中 订单状态(order_status） 和 支付编号（trade_no），重复的通知直接忽略
+        if data.get('trade_status') in TRADE_PAID:
+            if not mark_order_paid(order.order_id, data.get('trade_no')) and \
+                    OrderInfo.objects.filter(order_id=order.order_id, order_status=6).exists():
+                # 订单已经超时取消，库存已归还：记下来退款，不能当作已支付
+                flag_refund(order.order_id, data.get('trade_no'))
+
+        # 返回success，支付宝不再重复通知
+        return HttpResponse('success')
+
+
+# 查询订单结果(只读订单状态，不再轮询支付宝，由浏览器定时查询)
+# 传了wait参数时最多等待 settings.ORDER_PAY_WAIT 秒(几秒)，支付成功的通知到达后立即返回
 class OrderCheckView(View):
 
     def post(self, request):
@@ -397,59 +249,24 @@ class OrderCheckView(View):
         # 接受数据
         order_id = request.POST.get('order_id')
 
-        try:
-            order = OrderInfo.objects.get(order_id=order_id, user=user)
-        except OrderInfo.DoesNotExist:
-            return redirect(reverse('user:order'))
-
         # 校验数据
         if not order_id:
             return JsonResponse({'res': 1, 'errmsg': '无效的订单id'})
 
+        try:
+            order = get_order(order_id=order_id, user=user)
+        except OrderInfo.DoesNotExist:
+            return JsonResponse({'res': 1, 'errmsg': '订单错误'})
 
-        # 初始化
-        alipay = AliPay(
-            appid='2016092500595996',  # 应用的id
-            app_notify_url=None,  # 默认回调url
-            app_private_key_path=os.path.join(settings.BASE_DIR, "apps/order/app_private_key.pem"),
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥
-            alipay_public_key_path=os.path.join(settings.BASE_DIR, "apps/order/alipay_public_key.pem"),
-            sign_type="RSA2",  # RSA 或者 RSA2
-            debug=True  # 默认False  配合沙箱模式使用
-        )
-
-        for i in range(120):
-            import time
-            time.sleep(1)
-            try:
-                result = alipay.api_alipay_trade_query(out_trade_no=order_id)
-                trade_status = result.get('trade_status')
-                code = result.get('code')
-                if trade_status == 'TRADE_SUCCESS' and code == '10000':
-                    # 修改 OrderInfo 中 订单状态(order_status） 和 支付编号（trade_no）
-                    order.order_status = 4  # 去评价
-                    order.trade_no = result.get('trade_no')
-                    order.save()
-                    return JsonResponse({'res': 3})
-            except:
-                continue
-
-        sub_msg = result.get('sub_msg', '支付超时，请手动重新支付！')
-        return JsonResponse({'res': 2, 'errmsg': sub_msg})
+        status = order.order_status
+        if status == 1 and request.POST.get('wait'):
+            status = wait_order_paid(order_id, settings.ORDER_PAY_WAIT)
 
-        # print('----->', result)
-        """
-         {'code': '10000', 'msg': 'Success',
-          'buyer_logon_id': 'tqe***@sandbox.com', 
-          'buyer_pay_amount': '0.00', 'buyer_user_id': '2088102177497820',
-          'buyer_user_type': 'PRIVATE',
-          'invoice_amount': '0.00', 'out_trade_no': '201903041026136',
-          'point_amount': '0.00', 'receipt_amount': '0.00', 
-          'send_pay_date': '2019-03-07 14:44:09', 
-          'total_amount': '0.01', 
-          'trade_no': '2019030722001497820200941406',
-          'trade_status': 'TRADE_SUCCESS'}
-        """
+        if status == 1:
+            return JsonResponse({'res': 4, 'errmsg': '等待支付'})
+        if status in (2, 3, 4, 5):
+            return JsonResponse({'res': 3})
+        return JsonResponse({'res': 2, 'errmsg': '订单状态错误'})
 
 
 # 订单评论
@@ -463,7 +280,8 @@ class CommentView(LoginRequiredMixin, View):
             return redirect(reverse('user:order'))
 
         try:
-            order = OrderInfo.objects.get(order_id=order_id, user=user)
+            # 先查热表，再查归档表
+            order = get_order(order_id=order_id, user=user)
         except OrderInfo.DoesNotExist:
             return redirect(reverse('user:order'))
 
@@ -471,8 +289,8 @@ class CommentView(LoginRequiredMixin, View):
         # 根据订单状态获取订单的状态标题
         order.status_name = OrderInfo.ORDER_STATUS[str(order.order_status)]
 
-        # 获取订单商品信息
-        order_skus = OrderGoods.objects.filter(order=order_id)
+        # 获取订单商品信息(同时取出商品sku，模板中不再逐个查询)
+        order_skus = get_order_skus(order)
         for order_sku in order_skus:
             # 计算商品的小计
             amount = order_sku.count * order_sku.price
@@ -498,24 +316,32 @@ class CommentView(LoginRequiredMixin, View):
             return redirect(reverse('user:order'))
 
         # 获取评论条数
-        total_count = request.POST.get('total_count')
-        total_count = int(total_count)
+        try:
+            total_count = int(request.POST.get('total_count'))
+        except (TypeError, ValueError):
+            return redirect(reverse('user:order', kwargs={'page': 1}))
 
+        comments = {}
         for i in range(1, total_count+1):
             # 获取评论的商品id
             sku_id = request.POST.get('sku_%d' % i)  # sku_1 sku_2 sku_3
             # 获取评论的商品内容
             content = request.POST.get('content_%d' % i, '')  # content_1 content_2
             try:
-                order_goods = OrderGoods.objects.get(order=order, sku_id=sku_id)
-            except OrderGoods.DoesNotExist:
+                comments[int(sku_id)] = content
+            except (TypeError, ValueError):
                 continue
 
-            order_goods.comment = content
-            order_goods.save()
+        with transaction.atomic():
+            if comments:
+                # 一条update语句保存全部评论，只修改comment列
+                # update df_order_goods set comment=case sku_id when ... end where order_id=... and sku_id in (...)
+                OrderGoods.objects.filter(order=order, sku_id__in=list(comments.keys())).update(
+                    comment=Case(*[When(sku_id=sku_id, then=Value(content)) for sku_id, content in comments.items()],
+                                 default=F('comment'), output_field=CharField()))
 
-        order.order_status = 5  # 已完成
-        order.save()
+            # 已完成(只修改待评价的订单)
+            OrderInfo.objects.filter(order_id=order.order_id, order_status=4).update(order_status=5)
 
         return redirect(reverse('user:order', kwargs={'page': 1}))
 
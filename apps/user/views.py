@@ -3,12 +3,13 @@ from django.urls import reverse
 from django.views.generic import View
 from django.conf import settings
 from django.http import HttpResponse
-from django.core.paginator import Paginator
 from django.contrib.auth import authenticate, login, logout
 
 from apps.goods.models import GoodsSKU
 from apps.order.models import OrderGoods, OrderInfo
+from apps.order.archive import get_order_page
 from apps.user.models import User, Address
+from apps.cart.operations import GUEST_CART_COOKIE, merge_guest_cart
 
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer  # 加密
 from itsdangerous import SignatureExpired
@@ -16,6 +17,7 @@ from celery_tasks.tasks import send_register_active_email
 from utils.mixin import LoginRequiredMixin
 from django_redis import get_redis_connection
 import re
+from datetime import datetime
 
 # 注册
 class RegisterView(View):
@@ -135,6 +137,10 @@ class LoginView(View):
                 # 用户已激活 <记录用户的登陆状态>
                 login(request, user)
 
+                # 把游客购物车合并到用户的购物车(服务器端一次完成)
+                conn = get_redis_connection('default')
+                merge_guest_cart(conn, request, user)
+
                 # 获取登录后所要跳转的地址，默认跳转到首页（重定向）
                 next_url = request.GET.get('next', reverse('goods:index'))  # None
 
@@ -151,6 +157,8 @@ class LoginView(View):
                     response.set_cookie('username', username, max_age=7*24*3600)
                 else:
                     response.delete_cookie('username')
+                # 游客购物车已经合并
+                response.delete_cookie(GUEST_CART_COOKIE)
                 # 返回 response
                 return response
             else:
@@ -188,8 +196,12 @@ class UserInfoView(LoginRequiredMixin, View):
         con = get_redis_connection('default')
         history_key = 'history_%d' % user.id
 
-        # 获取用户浏览记录中最新5个商品的id
-        sku_ids = con.lrange(history_key, 0, 5)
+        # 获取用户浏览记录中最新5个商品的id(同时刷新浏览记录的过期时间)
+        pipe = con.pipeline(transaction=False)
+        pipe.lrange(history_key, 0, 5)
+        if settings.HISTORY_TTL:
+            pipe.expire(history_key, settings.HISTORY_TTL)
+        sku_ids = pipe.execute()[0]
 
         # 从数据库中查询sku_ids中商品的具体信息
         # goods_li = GoodsSKU.objects.filter(id__in=sku_ids)
@@ -207,68 +219,74 @@ class UserInfoView(LoginRequiredMixin, View):
 
 
 class UserOrderView(LoginRequiredMixin, View):
-    """用户中心-订单页"""
+    """
+    用户中心-订单页
+    按 (创建时间, 订单id) 倒序做游标分页：?after=上一页最后一个订单 / ?before=下一页第一个订单，
+    只查询一页的订单，再用一次查询取出这些订单的商品(不再为每个订单查询一次，也不再先查出全部订单)
+    历史订单归档后(apps/order/archive.py)照样显示
+    """
+    per_page = 2
+
     def get(self, request, page):
 
         user = request.user
-        # 获取用户的订单信息
-        orders = OrderInfo.objects.filter(user=user).order_by('-create_time')
 
-        # 循环遍历订单商品的信息
-        for order in orders:
+        # 页码只用于显示(要进行数据校验，安全处理)
+        try:
+            page = max(int(page), 1)
+        except Exception as e:
+            page = 1
 
-            # 查找本订单中所有的商品信息
-            order_skus = OrderGoods.objects.filter(order_id=order.order_id)
+        # 获取用户一页的订单信息(df_order_info 有 (user_id, create_time) 索引，热表数据不够时再查归档表)
+        # 同时一次查询取出本页订单的商品信息(同时取出商品sku)
+        after = self.parse_cursor(request.GET.get('after'))
+        before = self.parse_cursor(request.GET.get('before'))
+        if before:
+            # 上一页：正序取出比游标新的订单，再反转
+            orders = get_order_page(user, before, False, self.per_page + 1)
+            has_previous = len(orders) > self.per_page
+            orders = orders[:self.per_page][::-1]
+            has_next = True
+        else:
+            orders = get_order_page(user, after, True, self.per_page + 1)
+            has_next = len(orders) > self.per_page
+            orders = orders[:self.per_page]
+            has_previous = after is not None
+        if page == 1:
+            has_previous = False
 
-            for order_sku in order_skus:
+        for order in orders:
+            for order_sku in order.order_skus:
                 amount = int(order_sku.count) * order_sku.price
                 order_sku.amount = amount  # 该商品总价格
 
             # 保存订单状态
             order.status_name = OrderInfo.ORDER_STATUS[str(order.order_status)]
 
-            # 动态给order增加skus属性
-            order.order_skus = order_skus
-
-        # 分页
-        paginator = Paginator(orders, 2)
-
-        # 获取第page页的内容(要进行数据校验，安全处理)
-        try:
-            page = int(page)
-        except Exception as e:
-            page = 1
-
-        if page > paginator.num_pages:
-            page = 1
-
-        # 获取第page页的Page的实例化对象
-        order_page = paginator.get_page(page)
-
-        # todo: 进行页码的控制，页面上最多显示5个页码
-        # 1、总页数小于5页，页面上显示所有页码
-        # 2、如果当前页是前3页，显示1-5页
-        # 3、如果当前页是后3页，显示后5页
-        # 4、其他情况，显示当前页的前2页，当前页 和 当前页的后2页
-        num_pages = paginator.num_pages
-        if num_pages < 5:
-            pages = range(1, num_pages + 1)
-        elif page <= 3:
-            pages = range(1, 6)
-        elif num_pages - page <= 2:
-            pages = range(num_pages - 4, num_pages + 1)
-        else:
-            pages = range(page - 2, page + 3)
-
         # 组织上下文
         context = {
-            'order_page': order_page,
-            'pages': pages,
+            'orders': orders,
+            'page_number': page,
+            'previous_cursor': self.make_cursor(orders[0]) if orders and has_previous else None,
+            'next_cursor': self.make_cursor(orders[-1]) if orders and has_next else None,
             'page': 'order',
         }
         # 是用模板
         return render(request, 'user_center_order.html', context)
 
+    @staticmethod
+    def make_cursor(order):
+        return '%s,%s' % (order.create_time.isoformat(), order.order_id)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        # 游标：创建日期,订单id
+        try:
+            create_time, order_id = cursor.split(',', 1)
+            return datetime.strptime(create_time, '%Y-%m-%d').date(), order_id
+        except Exception:
+            return None
+
 
 class UserAddressView(LoginRequiredMixin, View):
     """用户中心-地址页"""
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 from celery import Celery
+from celery.schedules import crontab
+from celery.utils.log import get_task_logger
 from django.conf import settings
 from django.core.mail import send_mail
 from django.template import loader, RequestContext
@@ -16,10 +18,59 @@ django.setup()
 # from apps.goods.models import *  # 这个东西没用他，也会阻止celery启动？？？？
 # 这个要写到django.setup()下面，必须先Django初始化
 from apps.goods.models import IndexGoodsBanner, IndexPromotionBanner, IndexTypeBanner, GoodsType
+from apps.user.models import User, Address
+from apps.goods.stock import reconcile_stock
+from apps.goods.sales import flush_sales as _flush_sales
+from apps.order.archive import archive_orders as _archive_orders
+from apps.order.expiry import expire_orders
+from apps.order.payment import reconcile_payments as _reconcile_payments
+from apps.order.service import commit_order as _commit_order, set_ticket_result
 
 # 创建对象
 app = Celery('celery_tasks.tasks', broker='redis://127.0.0.1:6379/8')
 
+# 定时任务(celery -A celery_tasks.tasks beat)
+app.conf.beat_schedule = {
+    # 每天凌晨清理长期不用的购物车和浏览记录
+    'sweep-idle-redis-keys': {
+        'task': 'celery_tasks.tasks.sweep_idle_redis_keys',
+        'schedule': crontab(minute=0, hour=4),
+    },
+    # 每分钟核对redis库存镜像与mysql的库存(秒杀模式的预扣库存)
+    'reconcile-stock-mirror': {
+        'task': 'celery_tasks.tasks.reconcile_stock_mirror',
+        'schedule': 60.0,
+    },
+    # 每30秒取消超时未支付的订单，归还库存
+    'expire-unpaid-orders': {
+        'task': 'celery_tasks.tasks.expire_unpaid_orders',
+        'schedule': 30.0,
+    },
+    # 每30秒把redis中累加的商品销量写回mysql
+    'flush-sales': {
+        'task': 'celery_tasks.tasks.flush_sales',
+        'schedule': 30.0,
+    },
+    # 每天凌晨把历史订单移到归档表
+    'archive-orders': {
+        'task': 'celery_tasks.tasks.archive_orders',
+        'schedule': crontab(minute=30, hour=4),
+    },
+    # 每5分钟向支付平台核对待支付的订单(支付宝的异步通知可能丢失)
+    'reconcile-payments': {
+        'task': 'celery_tasks.tasks.reconcile_payments',
+        'schedule': 300.0,
+    },
+}
+
+# 下单任务单独走order队列，由专门的worker处理，并发数就是下单占用的数据库连接数
+# celery -A celery_tasks.tasks worker -Q order -c 4
+app.conf.task_routes = {
+    'celery_tasks.tasks.commit_order': {'queue': 'order'},
+}
+
+logger = get_task_logger(__name__)
+
 # 定义任务函数,注册时发送激活邮件
 @ app.task
 def send_register_active_email(to_email, username, token):
@@ -80,3 +131,138 @@ def generate_static_index_html():
     save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
     with open(save_path, 'w') as f:
         f.write(static_index_html)
+
+
+# 清理一批key：空闲超过过期时间的删除，没有设置过期时间的(旧数据)补上剩余的过期时间
+# 购物车的汇总(summary_<购物车key>)跟随购物车一起处理，回收的内存包含汇总占用的内存
+def _sweep_batch(conn, keys, ttl, stats):
+    related_keys = []
+    pipe = conn.pipeline(transaction=False)
+    for key in keys:
+        related = [key]
+        if key.startswith(b'cart_'):
+            related.append(b'summary_' + key)
+        related_keys.append(related)
+        pipe.object('idletime', key)
+        pipe.ttl(key)
+        for related_key in related:
+            pipe.execute_command('MEMORY', 'USAGE', related_key)
+    result = pipe.execute()
+
+    pipe = conn.pipeline(transaction=False)
+    offset = 0
+    for related in related_keys:
+        idle, key_ttl = result[offset:offset + 2]
+        memory = sum(usage or 0 for usage in result[offset + 2:offset + 2 + len(related)])
+        offset += 2 + len(related)
+        if idle is None:
+            # 遍历之后已经过期或被删除
+            continue
+
+        if idle >= ttl:
+            # 长期不用，删除
+            pipe.delete(*related)
+            stats['deleted'] += 1
+            stats['reclaimed_bytes'] += memory
+        elif key_ttl == -1:
+            # 没有设置过期时间，按空闲时间补上剩余的过期时间
+            for related_key in related:
+                pipe.expire(related_key, ttl - idle)
+            stats['expire_set'] += 1
+    pipe.execute()
+
+
+def _sweep_keys(conn, pattern, ttl, batch_size):
+    stats = {'scanned': 0, 'deleted': 0, 'expire_set': 0, 'reclaimed_bytes': 0}
+    if not ttl:
+        # 没有配置过期时间，不清理
+        return stats
+
+    keys = []
+    # SCAN 增量遍历，每次只取一小批，不会长时间阻塞redis
+    for key in conn.scan_iter(match=pattern, count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            _sweep_batch(conn, keys, ttl, stats)
+            stats['scanned'] += len(keys)
+            keys = []
+    if keys:
+        _sweep_batch(conn, keys, ttl, stats)
+        stats['scanned'] += len(keys)
+    return stats
+
+
+# 清理redis中长期不用的购物车和浏览记录（定时任务）
+@ app.task
+def sweep_idle_redis_keys(batch_size=500):
+    conn = get_redis_connection('default')
+    report = {
+        'cart': _sweep_keys(conn, 'cart_*', settings.CART_TTL, batch_size),
+        'history': _sweep_keys(conn, 'history_*', settings.HISTORY_TTL, batch_size),
+    }
+    for name, stats in report.items():
+        logger.info('sweep %s: scanned=%d deleted=%d expire_set=%d reclaimed=%d bytes',
+                    name, stats['scanned'], stats['deleted'], stats['expire_set'], stats['reclaimed_bytes'])
+    return report
+
+
+# 库存镜像对账：镜像 = mysql库存 - 进行中的预扣（定时任务）
+@ app.task
+def reconcile_stock_mirror(batch_size=1000):
+    conn = get_redis_connection('default')
+    checked, fixed = reconcile_stock(conn, batch_size)
+    logger.info('reconcile stock mirror: checked=%d fixed=%d', checked, fixed)
+    return {'checked': checked, 'fixed': fixed}
+
+
+# 排队下单：创建订单，结果写回排队号
+@ app.task(ignore_result=True)
+def commit_order(ticket, user_id, addr_id, pay_method, sku_ids):
+    conn = get_redis_connection('default')
+    try:
+        user = User.objects.get(id=user_id)
+        addr = Address.objects.get(id=addr_id)
+        result = _commit_order(user, addr, pay_method, sku_ids)
+    except Exception:
+        logger.exception('commit order failed: ticket=%s', ticket)
+        result = {'res': 7, 'errmsg': '下单失败'}
+    set_ticket_result(conn, ticket, user_id, result)
+
+
+# 核对待支付订单的支付结果（定时任务）
+@ app.task
+def reconcile_payments(days=3, batch_size=200, workers=8):
+    stats = _reconcile_payments(days=days, batch_size=batch_size, workers=workers)
+    match_rate = stats['paid'] / stats['checked'] if stats['checked'] else 0
+    logger.info('reconcile payments: batches=%d checked=%d paid=%d updated=%d failed=%d '
+                'seconds=%.3f match_rate=%.4f',
+                stats['batches'], stats['checked'], stats['paid'], stats['updated'], stats['failed'],
+                stats['seconds'], match_rate)
+    stats['match_rate'] = match_rate
+    return stats
+
+
+# 取消超时未支付的订单（定时任务）
+@ app.task
+def expire_unpaid_orders(batch_size=200):
+    conn = get_redis_connection('default')
+    due, cancelled, paid = expire_orders(conn, batch_size)
+    logger.info('expire unpaid orders: due=%d cancelled=%d paid=%d', due, cancelled, paid)
+    return {'due': due, 'cancelled': cancelled, 'paid': paid}
+
+
+# 归档历史订单（定时任务）
+@ app.task
+def archive_orders(batch_size=500):
+    archived = _archive_orders(batch_size)
+    logger.info('archive orders: archived=%d', archived)
+    return archived
+
+
+# 把redis中累加的商品销量写回mysql（定时任务）
+@ app.task
+def flush_sales(batch_size=500):
+    conn = get_redis_connection('default')
+    flushed = _flush_sales(conn, batch_size)
+    logger.info('flush sales: skus=%d', flushed)
+    return flushed
@@ -58,6 +58,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'apps.cart.context_processors.cart_count',  # 购物车角标
             ],
         },
     },
@@ -126,6 +127,58 @@ TINYMCE_DEFAULT_CONFIG = {
 # /accounts/login？next=/user
 LOGIN_URL = '/user/login'
 
+# 购物车 浏览记录 在redis中的空闲过期时间(秒)，每次访问时刷新，0 表示不过期
+CART_TTL = 30 * 24 * 3600
+HISTORY_TTL = 30 * 24 * 3600
+
+# 下单策略：
+# pessimistic  悲观锁，一条语句按id顺序锁住全部商品
+# optimistic   乐观锁，库存冲突时回滚事务，随机退避后重新执行，最多执行 ORDER_COMMIT_RETRIES 次(退避时间上限 ORDER_COMMIT_BACKOFF*2^n 秒)
+# reservation  秒杀模式，下单前先在redis库存镜像中预扣库存，抢到库存的请求才进入mysql事务
+ORDER_COMMIT_STRATEGY = 'optimistic'
+ORDER_COMMIT_RETRIES = 3
+ORDER_COMMIT_BACKOFF = 0.01
+# 悲观锁等锁的超时时间(秒)，超时后返回可重试的错误，不让请求长时间排队
+ORDER_LOCK_WAIT_TIMEOUT = 2
+# 秒杀模式预扣库存的有效期(秒)，超时未确认/归还的预扣(下单进程被杀掉)由库存对账任务丢弃
+ORDER_RESERVATION_TTL = 60
+
+# 排队下单：提交订单的请求放入celery的order队列，立即返回排队号，前端轮询 /order/status/<排队号>
+ORDER_QUEUED_CHECKOUT = False
+
+# 未支付的订单超时取消(秒)，取消后归还库存
+ORDER_PAY_TIMEOUT = 30 * 60
+# 离超时取消不到这么多秒的订单不再发起支付
+ORDER_PAY_MIN_SECONDS = 60
+
+# 下单幂等键保存结果的时间(秒)，重复提交时最多等待第一次提交结果的时间(秒)
+ORDER_IDEMPOTENCY_TTL = 10 * 60
+ORDER_IDEMPOTENCY_WAIT = 10
+# 处理中标记的过期时间(秒)：等待时间 + 下单的最长耗时，处理的进程中途退出后，过期了才能用同一个键重新提交
+ORDER_IDEMPOTENCY_PENDING_TTL = ORDER_IDEMPOTENCY_WAIT + 10
+
+# 查询支付结果时传了wait参数最多等待支付宝异步通知的秒数(占用一个web线程，只等几秒)
+# 支付页面不传wait，由浏览器定时查询
+ORDER_PAY_WAIT = 3
+
+# 核对支付结果时查询支付平台的客户端(本地测试可以换成 apps.order.payment.StubPaymentClient)
+ORDER_PAYMENT_CLIENT = 'apps.order.payment.AlipayClient'
+
+# 已完成、已取消的订单创建超过多少天后移到归档表
+ORDER_ARCHIVE_DAYS = 90
+
+# 支付宝(沙箱环境)，本地测试时可以把网关换成假的支付宝网关
+ALIPAY_APPID = '2016092500595996'
+ALIPAY_APP_PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/app_private_key.pem')
+# 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥
+ALIPAY_PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/alipay_public_key.pem')
+ALIPAY_SIGN_TYPE = 'RSA2'
+ALIPAY_GATEWAY = 'https://openapi.alipaydev.com/gateway.do'
+# 查询交易状态的超时时间(秒)
+ALIPAY_TIMEOUT = 15
+# 沙箱测试时统一支付的金额(元)，None 按订单的实际金额支付
+ALIPAY_PAY_AMOUNT = '0.01'
+
 # FastDFS设置-自定义存储的类
 DEFAULT_FILE_STORAGE = 'utils.fdfs.storage.FDFSStorage'
 
@@ -56,6 +56,16 @@ CACHES = {
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
         }
+    },
+    # 购物车角标使用的连接(超时时间短，redis慢时不会拖住商品页面)
+    'badge': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/9',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'SOCKET_CONNECT_TIMEOUT': 0.1,  # 秒
+            'SOCKET_TIMEOUT': 0.1,  # 秒
+        }
     }
 }
 
@@ -0,0 +1,12 @@
+# 已注册的lua脚本对象（进程内只计算一次sha，之后通过 evalsha 调用）
+_scripts = {}
+
+
+def run_script(conn, source, keys=(), args=()):
+    """
+    在redis服务器端执行lua脚本(一次往返，原子操作)
+    """
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = conn.register_script(source)
+    return script(keys=list(keys), args=list(args), client=conn)
@@ -0,0 +1,126 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+from django_redis import get_redis_connection
+
+from utils.redis_script import run_script
+
+# snowflake id：41位毫秒时间戳 | 10位worker id | 12位序号
+# 按时间递增，订单表按主键顺序追加写入；生成时不需要访问数据库
+EPOCH = 1546272000000  # 2019-01-01 00:00:00 +08:00 (毫秒)
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# redis中分配worker id的计数器(每次领取时从计数器的位置开始找空闲的worker id)
+WORKER_KEY = 'snowflake_worker'
+# worker id的租约 snowflake_worker_<worker id> -> 进程标识，过期之前由持有的进程续期
+LEASE_KEY_PREFIX = 'snowflake_worker_'
+LEASE_TTL = 60
+# 租约领取(续期)之后超过这个秒数，生成id前先续期
+LEASE_REFRESH = LEASE_TTL / 3
+
+# 领取worker id：从ARGV[1]开始依次尝试 set nx，返回领到的worker id，全部被占用返回-1
+# KEYS[1] 租约key前缀  ARGV[1] 开始的worker id  ARGV[2] 进程标识  ARGV[3] 租约秒数  ARGV[4] 最大worker id
+_LEASE_ACQUIRE = """
+local max_worker = tonumber(ARGV[4])
+for i = 0, max_worker do
+    local worker_id = (tonumber(ARGV[1]) + i) % (max_worker + 1)
+    if redis.call('set', KEYS[1] .. worker_id, ARGV[2], 'NX', 'EX', ARGV[3]) then
+        return worker_id
+    end
+end
+return -1
+"""
+
+# 续期：租约还属于本进程时延长过期时间，返回1；租约已过期或被别的进程领走返回0
+# KEYS[1] 租约key  ARGV[1] 进程标识  ARGV[2] 租约秒数
+_LEASE_REFRESH = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('expire', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class Snowflake(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker_id = None
+        self._token = None
+        self._leased_at = 0
+        self._last_ms = -1
+        self._sequence = 0
+
+    def _allocate_worker(self):
+        # 每个进程从redis租用一个worker id(uwsgi fork出的子进程pid不同，会重新领取)
+        # 租约过期之前别的进程领不到这个worker id，进程退出后租约过期，worker id可以再被使用
+        conn = get_redis_connection('default')
+        token = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        leased_at = time.time()
+        worker_id = run_script(conn, _LEASE_ACQUIRE, [LEASE_KEY_PREFIX],
+                               [conn.incr(WORKER_KEY) & MAX_WORKER, token, LEASE_TTL, MAX_WORKER])
+        if worker_id < 0:
+            raise RuntimeError('no free snowflake worker id')
+        self._worker_id = worker_id
+        self._token = token
+        self._leased_at = leased_at
+        self._pid = os.getpid()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def _refresh_lease(self):
+        # 续期租约；租约已经丢失(长时间没有生成id，过期后被别的进程领走)时重新领取
+        conn = get_redis_connection('default')
+        leased_at = time.time()
+        if run_script(conn, _LEASE_REFRESH, [LEASE_KEY_PREFIX + str(self._worker_id)], [self._token, LEASE_TTL]):
+            self._leased_at = leased_at
+        else:
+            self._allocate_worker()
+
+    def next_id(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._allocate_worker()
+            elif time.time() - self._leased_at > LEASE_REFRESH:
+                self._refresh_lease()
+
+            now = int(time.time() * 1000)
+            if now < self._last_ms:
+                # 系统时钟回拨，等到追上上一次的时间戳，避免生成重复的id
+                time.sleep((self._last_ms - now) / 1000.0)
+                now = self._last_ms
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 同一毫秒内的序号用完了，等到下一毫秒
+                    while now <= self._last_ms:
+                        now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+            self._last_ms = now
+
+            return ((now - EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | \
+                   (self._worker_id << SEQUENCE_BITS) | self._sequence
+
+
+_generator = Snowflake()
+
+
+def next_id():
+    """生成一个全局唯一、按时间递增的整数id"""
+    return _generator.next_id()
+
+
+def next_order_id():
+    """
+    生成订单id：定长19位数字字符串(order_id是字符型主键，补齐位数后字符串顺序与时间顺序一致)
+    """
+    return '%019d' % next_id()
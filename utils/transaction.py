@@ -0,0 +1,19 @@
+import logging
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def safe_on_commit(func):
+    """
+    事务提交后执行func(同步redis、累加销量等)，失败只记录日志：
+    数据已经提交，不能再让请求失败(Django 2.1 中 on_commit 的异常会抛给提交事务的调用方)，
+    这些数据由定时任务对账/重建
+    """
+    def run():
+        try:
+            func()
+        except Exception:
+            logger.exception('on_commit hook failed: %r', func)
+    transaction.on_commit(run)